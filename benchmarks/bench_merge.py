@@ -0,0 +1,98 @@
+# Benchmark of the three way text merge (`merge_files_by_lines`) against the
+# old merge that compared the lines by position.
+# Usage: python benchmarks/bench_merge.py [--lines N] [--repeat N]
+
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Iterator
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wit
+
+
+def legacy_file_lines_generator(file_path: str) -> Iterator[str]:
+    """Yield lines from file (the old implementation, reads the whole file)."""
+    try:
+        with open(file_path, "r", encoding="utf-8") as file:
+            file: list[str] = file.readlines()
+        for line in file:
+            yield line
+    except FileNotFoundError:
+        yield ""
+
+
+def legacy_merge_files_by_lines(current_file_path: str, merge_file_path: str, parent_file_path: str, output_path: str) -> int:
+    """The old merge by position of the lines (returns 1 on the first conflict)."""
+    current_file: Iterator[str] = legacy_file_lines_generator(current_file_path)
+    merge_file: Iterator[str] = legacy_file_lines_generator(merge_file_path)
+    parent_file: Iterator[str] = legacy_file_lines_generator(parent_file_path)
+    fixed_file: str = ""
+    for merge_file_line in merge_file:
+        parent_file_line: str = next(parent_file, "")
+        current_file_line: str = next(current_file, "")
+        if merge_file_line == current_file_line:
+            fixed_file += merge_file_line
+        elif merge_file_line == parent_file_line:
+            fixed_file += current_file_line
+        elif current_file_line == parent_file_line:
+            fixed_file += merge_file_line
+        else:
+            return 1
+    for line in current_file:
+        fixed_file += line
+    with open(output_path, "w") as file:
+        file.write(fixed_file)
+    return 0
+
+
+def write_versions(folder: str, lines: int) -> tuple[str, str, str]:
+    """Write base, current (line inserted at the top) and merge (line changed at the bottom) files."""
+    paths: tuple[str, str, str] = tuple(os.path.join(folder, name) for name in ("base.txt", "current.txt", "merge.txt"))
+    base_lines: list[str] = [f"line {number} of the generated file\n" for number in range(lines)]
+    versions: list[list[str]] = [base_lines,
+                                 ["inserted line\n"] + base_lines,
+                                 base_lines[:-1] + ["changed last line\n"]]
+    for path, version in zip(paths, versions):
+        with open(path, "w") as file:
+            file.writelines(version)
+    return paths
+
+
+def measure(merge_function: Callable[..., int], paths: tuple[str, str, str], output_path: str, repeat: int) -> dict[str, float]:
+    """Return best time, peak traced memory and conflicts of a merge function."""
+    base_path, current_path, merge_path = paths
+    times: list[float] = []
+    for _ in range(repeat):
+        start: float = time.perf_counter()
+        conflicts: int = merge_function(current_path, merge_path, base_path, output_path)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    merge_function(current_path, merge_path, base_path, output_path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": min(times), "peak_mib": peak / 2 ** 20, "conflicts": conflicts}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the three way text merge.")
+    parser.add_argument("--lines", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    print(f"{'lines':>10} {'implementation':>15} {'seconds':>10} {'peak MiB':>10} {'conflicts':>10}")
+    with tempfile.TemporaryDirectory() as folder:
+        output_path: str = os.path.join(folder, "output.txt")
+        for lines in args.lines:
+            paths: tuple[str, str, str] = write_versions(folder, lines)
+            for name, merge_function in (("positional", legacy_merge_files_by_lines), ("diff3", wit.merge_files_by_lines)):
+                result: dict[str, float] = measure(merge_function, paths, output_path, args.repeat)
+                print(f"{lines:>10} {name:>15} {result['seconds']:>10.4f} {result['peak_mib']:>10.2f} {result['conflicts']:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+# Benchmark of every wit command on generated repositories.
+# Every command runs in its own process (like `python wit.py <commend>`), and
+# the wall time, peak RSS and bytes read/written of that process are recorded.
+# Linux only (uses `os.wait4` and `/proc/self/io`), runs fully offline.
+#
+# Usage:
+#   python benchmarks/bench_wit.py --files 2000 --history 20 --output results.json
+#   python benchmarks/bench_wit.py --compare old.json new.json
+
+
+import argparse
+from dataclasses import asdict, dataclass
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+# Commands in every measured `batch` run.
+BATCH_COMMANDS: int = 20
+WIT_PATH: str = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "wit.py")
+# Runs one wit command in the child process and writes its I/O counters to a file.
+CHILD_CODE: str = """
+import importlib.util, json, sys
+wit_path, counters_path = sys.argv[1], sys.argv[2]
+spec = importlib.util.spec_from_file_location("wit", wit_path)
+wit = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(wit)
+if sys.argv[3:4] == ["graph"]:
+    try:
+        import graphviz
+        graphviz.Source.view = graphviz.Source.render  # Do not open a viewer.
+    except ImportError:
+        pass
+wit.main([wit_path] + sys.argv[3:])
+with open("/proc/self/io") as file:
+    counters = {key: int(value) for key, value in (line.split(": ") for line in file)}
+with open(counters_path, "w") as file:
+    json.dump(counters, file)
+"""
+
+
+@dataclass
+class RepositoryConfig:
+    """Shape of a generated repository."""
+    files: int = 1000
+    file_size: int = 4096
+    depth: int = 3
+    history: int = 10
+    merge_density: float = 0.2
+    changed_files: float = 0.01
+    seed: int = 0
+
+
+class Benchmark:
+    """Generates a repository and runs wit commands in it, collecting measurements."""
+
+    def __init__(self, config: RepositoryConfig, folder: str, repeat: int) -> None:
+        self.config: RepositoryConfig = config
+        self.folder: str = folder
+        self.repeat: int = repeat
+        self.random: random.Random = random.Random(config.seed)
+        self.files: list[str] = []
+        self.results: list[dict] = []
+
+    def run_wit(self, *args: str, check: bool = True, stdin: str | None = None) -> dict[str, float]:
+        """Run one wit command in a new process (with stdin, for `batch`) and return its measurements."""
+        with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as counters_file:
+            counters_path: str = counters_file.name
+        start: float = time.perf_counter()
+        process = subprocess.Popen([sys.executable, "-c", CHILD_CODE, WIT_PATH, counters_path, *args],
+                                   cwd=self.folder, stdin=subprocess.PIPE if stdin is not None else None,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if stdin is not None:
+            process.stdin.write(stdin.encode())
+            process.stdin.close()
+        _, status, usage = os.wait4(process.pid, 0)
+        wall_seconds: float = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        error: str = process.stderr.read().decode(errors="replace")
+        process.stderr.close()
+        if process.returncode != 0:
+            os.remove(counters_path)
+            if check:
+                raise RuntimeError(f"`wit {' '.join(args)}` failed:\n{error}")
+            return {}
+        with open(counters_path) as file:
+            counters: dict[str, int] = json.load(file)
+        os.remove(counters_path)
+        return {"wall_seconds": wall_seconds,
+                "max_rss_kib": usage.ru_maxrss,
+                "read_chars": counters["rchar"],
+                "write_chars": counters["wchar"],
+                "read_bytes": counters["read_bytes"],
+                "write_bytes": counters["write_bytes"]}
+
+    def measure(self, command: str, phase: str, *args: str, repeat: bool = False, stdin: str | None = None) -> None:
+        """Run a command (several times if it does not change the repository) and record the median."""
+        runs: list[dict[str, float]] = [self.run_wit(command, *args, stdin=stdin) for _ in range(self.repeat if repeat else 1)]
+        result: dict = {"command": command, "phase": phase}
+        for key in runs[0]:
+            result[key] = statistics.median(run[key] for run in runs)
+        self.results.append(result)
+
+    def write_random_file(self, file: str) -> None:
+        """Write a text file of `file_size` bytes with random lines."""
+        path: str = os.path.join(self.folder, file)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        line_count: int = max(1, self.config.file_size // 64)
+        with open(path, "w") as output:
+            for _ in range(line_count):
+                output.write(f"{self.random.getrandbits(240):060x}\n")
+
+    def generate_tree(self) -> None:
+        """Create the working tree files spread over folders of the configured depth."""
+        for number in range(self.config.files):
+            depth: int = self.random.randint(0, self.config.depth)
+            folders: list[str] = [f"dir{self.random.randrange(8)}" for _ in range(depth)]
+            self.files.append("/".join(folders + [f"file{number}.txt"]))
+            self.write_random_file(self.files[-1])
+
+    def change_files(self, branch_tag: str, skipped: set[str] = frozenset()) -> set[str]:
+        """Append a line to a fraction of the files (not to the skipped files), return the changed files."""
+        candidates: list[str] = [file for file in self.files if file not in skipped]
+        count: int = min(len(candidates), max(1, int(self.config.files * self.config.changed_files)))
+        changed: list[str] = self.random.sample(candidates, count)
+        for file in changed:
+            with open(os.path.join(self.folder, file), "a") as output:
+                output.write(f"{branch_tag} {self.random.getrandbits(64):016x}\n")
+        return set(changed)
+
+    def run(self) -> list[dict]:
+        """Generate the repository and measure every command."""
+        self.generate_tree()
+        self.measure("init", "empty")
+        self.measure("add", "all files", ".")
+        self.measure("commit", "first", "first commit")
+        self.measure("status", "clean", repeat=True)
+        self.measure("add", "unchanged", ".", repeat=True)
+        for number in range(self.config.history):
+            if self.random.random() < self.config.merge_density:
+                branch_name: str = f"topic{number}"
+                self.run_wit("branch", branch_name)
+                self.run_wit("checkout", branch_name)
+                topic_files: set[str] = self.change_files(branch_name)
+                self.run_wit("add", ".")
+                self.run_wit("commit", f"{branch_name} work")
+                self.run_wit("checkout", "master")
+                # Lines appended to the same file on both branches would conflict.
+                self.change_files("master", topic_files)
+                self.run_wit("add", ".")
+                self.run_wit("commit", f"master work {number}")
+                self.measure("merge", "topic branch", branch_name)
+                self.run_wit("checkout", "master")
+            else:
+                self.change_files("master")
+                self.measure("status", "changed files")
+                self.measure("add", "changed files", ".")
+                self.measure("commit", "history", f"commit {number}")
+        self.run_wit("branch", "other")
+        self.run_wit("checkout", "other")
+        self.change_files("other")
+        self.run_wit("add", ".")
+        self.run_wit("commit", "other work")
+        self.measure("checkout", "switch branch", "master")
+        self.measure("checkout", "switch back", "other")
+        self.measure("log", "head", "--max-count=20", repeat=True)
+        self.measure("log", "path", "--", self.files[0], repeat=True)
+        self.measure("graph", "head", "--format=dot", f"--output={os.devnull}", repeat=True)
+        self.measure("graph", "all", "--all", "--format=text", f"--output={os.devnull}", repeat=True)
+        # The same commands in one process, compare with BATCH_COMMANDS times the single commands.
+        self.measure("batch", f"{BATCH_COMMANDS} status", repeat=True, stdin="status\n" * BATCH_COMMANDS)
+        self.measure("batch", f"{BATCH_COMMANDS} log", repeat=True, stdin="log --max-count=20\n" * BATCH_COMMANDS)
+        return self.results
+
+
+def summarize(results: list[dict]) -> dict[tuple[str, str], dict]:
+    """Return the median of every (command, phase) over its measurements."""
+    groups: dict[tuple[str, str], list[dict]] = {}
+    for result in results:
+        groups.setdefault((result["command"], result["phase"]), []).append(result)
+    return {key: {field: statistics.median(result[field] for result in group)
+                  for field in group[0] if field not in ("command", "phase")}
+            for key, group in groups.items()}
+
+
+def print_results(results: list[dict]) -> None:
+    """Print a table of the measurements."""
+    print(f"{'command':>10} {'phase':>15} {'seconds':>9} {'RSS MiB':>8} {'read MiB':>9} {'written MiB':>11}")
+    for (command, phase), result in summarize(results).items():
+        print(f"{command:>10} {phase:>15} {result['wall_seconds']:>9.3f} {result['max_rss_kib'] / 1024:>8.1f} "
+              f"{result['read_chars'] / 2 ** 20:>9.2f} {result['write_chars'] / 2 ** 20:>11.2f}")
+
+
+def compare(old_path: str, new_path: str) -> None:
+    """Print the ratio new/old of every measurement that exists in both result files."""
+    with open(old_path) as file:
+        old: dict[tuple[str, str], dict] = summarize(json.load(file)["results"])
+    with open(new_path) as file:
+        new: dict[tuple[str, str], dict] = summarize(json.load(file)["results"])
+    print(f"{'command':>10} {'phase':>15} {'old s':>9} {'new s':>9} {'time':>7} {'RSS':>7} {'read':>7} {'written':>7}")
+    for key in [key for key in old if key in new]:
+        ratios: list[str] = []
+        for field in ("wall_seconds", "max_rss_kib", "read_chars", "write_chars"):
+            ratios.append(f"{new[key][field] / old[key][field]:>6.2f}x" if old[key][field] else f"{'-':>7}")
+        print(f"{key[0]:>10} {key[1]:>15} {old[key]['wall_seconds']:>9.3f} {new[key]['wall_seconds']:>9.3f} {' '.join(ratios)}")
+
+
+def get_revision() -> str:
+    """Return the git revision of wit.py (or its sha1 if it is not in a git repository)."""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(WIT_PATH), capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        import hashlib
+        with open(WIT_PATH, "rb") as file:
+            return hashlib.sha1(file.read()).hexdigest()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark every wit command on a generated repository.")
+    defaults: RepositoryConfig = RepositoryConfig()
+    parser.add_argument("--files", type=int, default=defaults.files, help="number of files in the working tree")
+    parser.add_argument("--file-size", type=int, default=defaults.file_size, help="size of every file in bytes")
+    parser.add_argument("--depth", type=int, default=defaults.depth, help="maximal folders depth")
+    parser.add_argument("--history", type=int, default=defaults.history, help="number of commits after the first")
+    parser.add_argument("--merge-density", type=float, default=defaults.merge_density,
+                        help="probability that a history step is a merge of a topic branch")
+    parser.add_argument("--changed-files", type=float, default=defaults.changed_files,
+                        help="fraction of the files that change in every commit")
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument("--repeat", type=int, default=3, help="runs of the commands that do not change the repository")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the generated repository")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files")
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+    config = RepositoryConfig(args.files, args.file_size, args.depth, args.history,
+                              args.merge_density, args.changed_files, args.seed)
+    folder: str = tempfile.mkdtemp(prefix="wit-bench-")
+    try:
+        results: list[dict] = Benchmark(config, folder, args.repeat).run()
+    finally:
+        if args.keep:
+            print(f"Repository kept in {folder}")
+        else:
+            shutil.rmtree(folder, ignore_errors=True)
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"revision": get_revision(),
+                       "python": platform.python_version(),
+                       "platform": platform.platform(),
+                       "config": asdict(config),
+                       "results": results}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,251 +1,937 @@
 # A project that allows version control, backup and 
 # tracking of projects(similar to GIT).
 # Supports the following commands:
-# init, add, commit, status, checkout, graph, branch and merge.
+# init, add, commit, status, checkout, graph, branch, merge, log, repack, gc, sparse,
+# remote, push, fetch, watch and batch.
 # An exercise from Yam Mesica Python course.
 
 
+from array import array
+import bisect
+from collections.abc import Callable, Container, Iterable, Iterator
+import contextlib
 from datetime import datetime
-import filecmp
+import errno
+import functools
+import hashlib
+import heapq
+import itertools
+import json
+import mmap
 import os
 import random
+import re
+import shlex
 import shutil
+from stat import S_ISDIR
+import struct
 import sys
+import tempfile
 import time
-from typing import Iterator
+import zlib
 
-import graphviz
+try:
+    import fcntl
+except ImportError:  # Not available on Windows.
+    fcntl = None
 
 
 BASE_FOLDER_NAME: str = ".wit"
 SUB_FOLDER_NAMES: dict[str, str] = {"images": "images", 
-                                    "staging_area": "staging_area"}
+                                    "staging_area": "staging_area", 
+                                    "objects": "objects"}
+BLOCK_SIZE: int = 1024 * 1024
+FICLONE: int = 0x40049409
+INDEX_FILE_NAME: str = "index.json"
+GRAPHS_FOLDER_NAME: str = "graphs"
+SPARSE_FILE_NAME: str = "sparse.txt"
+# The commit of a merge that stopped on conflicts, the second parent of the next commit.
+MERGE_HEAD_FILE_NAME: str = "merge_head.txt"
+REMOTES_FILE_NAME: str = "remotes.txt"
+COMMIT_GRAPH_FILE_NAME: str = "commit-graph.txt"
+PACK_FOLDER_NAME: str = "pack"
+PACK_SIGNATURE: bytes = b"WITPACK1"
+PACK_INDEX_SIGNATURE: bytes = b"WITIDX01"
+PACK_ENTRY_HEADER: struct.Struct = struct.Struct(">BQ")
+PACK_INDEX_RECORD: struct.Struct = struct.Struct(">20sQ")
+PACK_FULL_ENTRY, PACK_DELTA_ENTRY = 0, 1
+DELTA_INSTRUCTION: struct.Struct = struct.Struct(">BQQ")
+DELTA_COPY, DELTA_INSERT = 0, 1
+# Only objects up to this size are stored as deltas (deltas are rebuilt in memory).
+DELTA_MAX_SIZE: int = 16 * BLOCK_SIZE
+DELTA_MAX_DEPTH: int = 10
+# Objects of at least this size are stored by `repack` as content-defined chunks (see `find_chunk_end`)
+# and a chunk list, so the versions of a large file share their unchanged chunks.
+CHUNKED_FILE_MIN_SIZE: int = 8 * BLOCK_SIZE
+CHUNK_MIN_SIZE: int = BLOCK_SIZE // 2
+CHUNK_AVERAGE_SIZE: int = BLOCK_SIZE
+CHUNK_MAX_SIZE: int = 4 * BLOCK_SIZE
+# Masks of the rolling hash before and after the average size (more bits cut less often).
+CHUNK_HARD_MASK: int = (1 << 19) - 1
+CHUNK_EASY_MASK: int = (1 << 17) - 1
+CHUNK_LIST_SUFFIX: str = ".chunks"
+# Random 64 bit value of every byte for the gear rolling hash.
+GEAR_TABLE: list[int] = [int.from_bytes(hashlib.sha1(bytes([byte])).digest()[:8], "big") for byte in range(256)]
+# Fewer files are hashed in the main thread, see `hash_files`.
+HASH_POOL_MIN_FILES: int = 8
+# Number of threads that hash files (the default is the number of CPUs, at most 32).
+HASH_WORKERS_ENVIRONMENT_NAME: str = "WIT_HASH_WORKERS"
+# Above this edit distance two versions of a region are treated as completely different.
+DIFF_MAX_COST: int = 10_000
+# Merges of fewer files run in the main process, a pool of worker processes costs more than it saves.
+MERGE_POOL_MIN_FILES: int = 8
+# Unreachable commits and objects and leftover files are kept this long by `gc` (seconds).
+GC_GRACE_PERIOD: int = 14 * 24 * 60 * 60
+# `gc` keeps this many marked object IDs in memory, the others in sorted files (see `ObjectMarks`).
+GC_MARKS_IN_MEMORY: int = 1_000_000
+# More sorted files of marked object IDs than this are merged into one.
+GC_MARKS_MAX_FILES: int = 8
+# Shortest commit ID prefix that is resolved to a commit.
+SHORT_ID_MIN_LENGTH: int = 4
+TRACE_ENVIRONMENT_NAME: str = "WIT_TRACE"
+TRACE_FILE_ENVIRONMENT_NAME: str = "WIT_TRACE_FILE"
+TRACE_FORMATS: tuple[str, ...] = ("text", "json", "chrome")
+GRAPH_FORMATS: tuple[str, ...] = ("svg", "dot", "text")
+# Files modified this close to the index save time may change again without
+# changing their size/mtime, so their cached hash is not trusted.
+RACY_WINDOW_NS: int = 2_000_000_000
+IGNORE_FILE_NAME: str = ".witignore"
+FSMONITOR_FOLDER_NAME: str = "fsmonitor"
+FSMONITOR_COOKIES_FOLDER_NAME: str = "cookies"
+FSMONITOR_JOURNAL_NAME: str = "journal.txt"
+FSMONITOR_WATCHER_FILE_NAME: str = "watcher.txt"
+FSMONITOR_STATE_FILE_NAME: str = "state.json"
+# A new journal (with a new token) is started when it grows over this size.
+FSMONITOR_JOURNAL_MAX_SIZE: int = 64 * BLOCK_SIZE
+FSMONITOR_TIMEOUT: float = 2.0
+FSMONITOR_POLL_INTERVAL: float = 0.5
+INOTIFY_EVENT: struct.Struct = struct.Struct("iIII")
+IN_MODIFY: int = 0x2
+IN_MOVED_FROM: int = 0x40
+IN_MOVED_TO: int = 0x80
+IN_CREATE: int = 0x100
+IN_DELETE: int = 0x200
+IN_DELETE_SELF: int = 0x400
+IN_MOVE_SELF: int = 0x800
+IN_Q_OVERFLOW: int = 0x4000
+IN_IGNORED: int = 0x8000
+IN_ONLYDIR: int = 0x1000000
+IN_DONT_FOLLOW: int = 0x2000000
+IN_ISDIR: int = 0x40000000
+INOTIFY_MASK: int = (IN_MODIFY | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+                     | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+
+# The active trace (None when tracing is disabled), see `start_tracing`.
+tracer: dict | None = None
+NO_TRACE_SPAN: contextlib.nullcontext = contextlib.nullcontext()
+
+
+class TraceSpan:
+    """Context manager that records the time of one phase in the active trace."""
+
+    def __init__(self, name: str) -> None:
+        self.name: str = name
+        self.span: list = []
+
+    def __enter__(self) -> None:
+        self.span = [self.name, len(tracer["stack"]), time.perf_counter_ns(), None]
+        tracer["spans"].append(self.span)
+        tracer["stack"].append(self.name)
+
+    def __exit__(self, *exc_info) -> None:
+        self.span[3] = time.perf_counter_ns()
+        tracer["stack"].pop()
+
+
+def trace_span(name: str) -> TraceSpan | contextlib.nullcontext:
+    """Return a context manager that records a timing span (does nothing if tracing is disabled)."""
+    if tracer is None:
+        return NO_TRACE_SPAN
+    return TraceSpan(name)
+
+
+def traced(function: Callable) -> Callable:
+    """Decorator that records every call of the function as a span when tracing is enabled."""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if tracer is None:
+            return function(*args, **kwargs)
+        with TraceSpan(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def trace_count(name: str, value: int = 1) -> None:
+    """Add value to a trace counter (hot loops check `tracer is not None` before calling)."""
+    if tracer is not None:
+        tracer["counters"][name] = tracer["counters"].get(name, 0) + value
+
+
+def start_tracing(trace_format: str) -> None:
+    """Enable tracing, the trace is written by `finish_tracing` in the format: text, json or chrome."""
+    global tracer
+    if trace_format not in TRACE_FORMATS:
+        raise ValueError(f"Unknown trace format `{trace_format}` (use one of: {', '.join(TRACE_FORMATS)}).")
+    tracer = {"format": trace_format, "start": time.perf_counter_ns(), "spans": [], "stack": [], "counters": {}}
+
+
+def finish_tracing() -> None:
+    """Write the trace to `WIT_TRACE_FILE` (or to stderr) and disable tracing."""
+    global tracer
+    trace, tracer = tracer, None
+    end: int = time.perf_counter_ns()
+    spans: list[list] = [[name, depth, start, end if span_end is None else span_end]
+                         for name, depth, start, span_end in trace["spans"]]
+    if trace["counters"].get("hash_batch_ns"):
+        trace["counters"]["hash_batch_mib_per_second"] = round(
+            trace["counters"]["hash_batch_bytes"] / 2 ** 20 / (trace["counters"]["hash_batch_ns"] / 1e9))
+    if trace["format"] == "text":
+        lines: list[str] = [f"wit trace: {(end - trace['start']) / 1e6:.3f} ms"]
+        lines.extend(f"{'  ' * (depth + 1)}{name:<{40 - 2 * depth}} {(span_end - start) / 1e6:>10.3f} ms"
+                     for name, depth, start, span_end in spans)
+        lines.append("counters:")
+        lines.extend(f"  {name:<40} {value:>10}" for name, value in sorted(trace["counters"].items()))
+        output: str = "\n".join(lines) + "\n"
+    elif trace["format"] == "json":
+        output = json.dumps({"duration_ms": (end - trace["start"]) / 1e6,
+                             "spans": [{"name": name, "depth": depth, "start_ms": (start - trace["start"]) / 1e6,
+                                        "duration_ms": (span_end - start) / 1e6}
+                                       for name, depth, start, span_end in spans],
+                             "counters": trace["counters"]}, indent=2) + "\n"
+    else:
+        # Chrome trace event format (chrome://tracing, Perfetto).
+        events: list[dict] = [{"name": name, "cat": "wit", "ph": "X", "pid": os.getpid(), "tid": 0,
+                               "ts": (start - trace["start"]) / 1e3, "dur": (span_end - start) / 1e3}
+                              for name, _, start, span_end in spans]
+        events.append({"name": "counters", "ph": "C", "pid": os.getpid(), "tid": 0,
+                       "ts": (end - trace["start"]) / 1e3, "args": trace["counters"]})
+        output = json.dumps({"traceEvents": events}) + "\n"
+    trace_file: str | None = os.environ.get(TRACE_FILE_ENVIRONMENT_NAME)
+    if trace_file:
+        with open(trace_file, "w") as file:
+            file.write(output)
+    else:
+        sys.stderr.write(output)
 
 
-def find_wit_folder() -> None:
-    """Find `.wit` folder."""
-    while BASE_FOLDER_NAME not in os.listdir():
-        os.chdir("..")
-        if os.getcwd() == os.path.abspath(os.sep):
-            raise FileNotFoundError("not a wit repository (or any of the parent directories): .wit")
+def map_file(file) -> mmap.mmap:
+    """Map a (not empty) file for reading from start to end."""
+    data: mmap.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mmap, "MADV_SEQUENTIAL"):
+        data.madvise(mmap.MADV_SEQUENTIAL)
+    return data
 
 
-def update_activated_branch_file(branch: str) -> None:
-    """Update activated branch file."""
-    with open(os.path.join(BASE_FOLDER_NAME, "activated.txt"), "w") as f:
-        f.write(branch)
+def digest_file(file_path: str) -> tuple[str, int]:
+    """Return the object ID (sha1 of the content) and the size of a file (not traced, it runs in hashing threads).
 
+    Small files are read with one call, large files are hashed through a memory map.
+    """
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as file:
+        size: int = os.fstat(file.fileno()).st_size
+        if size >= BLOCK_SIZE:
+            with map_file(file) as data:
+                digest.update(data)
+        else:
+            digest.update(file.read())
+    return digest.hexdigest(), size
 
-def init() -> None:
-    """Initializing wit in current folder."""
-    os.mkdir(BASE_FOLDER_NAME)
-    for folder in SUB_FOLDER_NAMES.values():
-        os.mkdir(os.path.join(BASE_FOLDER_NAME, folder))
-    update_activated_branch_file("master")
-    print(f"Initialized empty wit repository in {os.getcwd()}")
 
+def hash_file(file_path: str) -> str:
+    """Return the object ID (sha1 of the content) of a file."""
+    object_id, size = digest_file(file_path)
+    if tracer is not None:
+        trace_count("files_hashed")
+        trace_count("bytes_hashed", size)
+    return object_id
 
-def get_new_folder_name() -> str:
-    """Return new folder image name."""
-    characters: str = "1234567890abcdef"
-    folder_name_len: int = 40
-    while True:
-        folder_name: str = "".join(random.choices(characters, k=folder_name_len))
-        if folder_name not in os.listdir():
-            return folder_name
-        
-
-def add(path: str) -> None:
-    """Adding the tree folders of the path to the `staging_area`."""
-    if path == ".":
-        path = os.getcwd()
-    source_path: str = os.path.abspath(path)
-    base: str = os.path.basename(source_path)
-    if base == BASE_FOLDER_NAME:
-        raise ValueError(f"Do not back up the `{BASE_FOLDER_NAME}` folder itself.")
-    # To search `.wit` folder from the folder source path.
-    if os.path.isfile(source_path):
-        os.chdir(source_path.removesuffix(base))
-    else:
-        os.chdir(source_path)
-    find_wit_folder()
-    destination_path: str = os.path.join(os.getcwd(), ".wit", "staging_area", os.path.relpath(source_path))
-    if os.path.isdir(source_path):
-        shutil.copytree(source_path, destination_path, ignore=lambda x, y : BASE_FOLDER_NAME, dirs_exist_ok=True)
-    else:
-        os.makedirs(destination_path.removesuffix(base), exist_ok=True)
-        shutil.copy2(source_path, destination_path)
 
+def get_hash_workers() -> int:
+    """Return the number of hashing threads (`WIT_HASH_WORKERS`, or the number of usable CPUs, at most 32)."""
+    workers: str | None = os.environ.get(HASH_WORKERS_ENVIRONMENT_NAME)
+    if workers:
+        return max(1, int(workers))
+    return min(32, len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1)
 
-def get_activated_branch() -> str:
-    """Return the activated branch."""
-    try:
-        with open(os.path.join(BASE_FOLDER_NAME, "activated.txt"), "r") as f:
-            return f.read().strip()
-    except FileNotFoundError:
-        return ""
+
+def hash_files(file_paths: list[str], workers: int | None = None) -> list[str | None]:
+    """Return the object IDs of many files (None for a file that does not exist), hashed by a pool of threads.
+
+    Reading and sha1 release the GIL, so the threads keep several reads in flight and hash on
+    several cores. Every thread gets slices of files (not one file at a time), so small files do not
+    pay a handoff each. Fewer than `HASH_POOL_MIN_FILES` files are hashed in the calling thread.
+    The trace counts the batches, their bytes and wall time, and the throughput of the batches.
+
+    Args:
+        file_paths (list[str]): Files to hash.
+        workers (int | None, optional): Number of threads. Defaults to None (see `get_hash_workers`).
+
+    Returns:
+        list[str | None]: Object ID of every file, in the order of the paths.
+    """
+    def digest_existing_files(file_paths: list[str]) -> list[tuple[str | None, int]]:
+        results: list[tuple[str | None, int]] = []
+        for file_path in file_paths:
+            try:
+                results.append(digest_file(file_path))
+            except FileNotFoundError:
+                results.append((None, 0))
+        return results
+
+    workers = min(workers or get_hash_workers(), len(file_paths))
+    start: int = time.perf_counter_ns()
+    with trace_span("hash_files"):
+        if workers <= 1 or len(file_paths) < HASH_POOL_MIN_FILES:
+            results: list[tuple[str | None, int]] = digest_existing_files(file_paths)
+        else:
+            import concurrent.futures
+            # A few slices per thread, so threads that got larger files do not hold the others back.
+            slice_size: int = -(-len(file_paths) // (4 * workers))
+            with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+                results = list(itertools.chain.from_iterable(pool.map(
+                    digest_existing_files, (file_paths[start:start + slice_size] for start in range(0, len(file_paths), slice_size)))))
+    if tracer is not None:
+        size: int = sum(size for _, size in results)
+        trace_count("files_hashed", sum(object_id is not None for object_id, _ in results))
+        trace_count("bytes_hashed", size)
+        trace_count("hash_batches")
+        trace_count("hash_batch_bytes", size)
+        trace_count("hash_batch_ns", time.perf_counter_ns() - start)
+        tracer["counters"]["hash_workers"] = max(workers, tracer["counters"].get("hash_workers", 0))
+    return [object_id for object_id, _ in results]
+
+
+def find_chunk_end(data, start: int, end: int) -> int:
+    """Return the end of the chunk that starts at start (FastCDC content-defined chunking).
+
+    A gear rolling hash of the last bytes is computed from `CHUNK_MIN_SIZE` bytes into the chunk,
+    and the chunk ends where the hash matches a mask: a hard mask until `CHUNK_AVERAGE_SIZE`
+    and an easy one after it (so the sizes stay close to the average), or at `CHUNK_MAX_SIZE`.
+    The ends depend only on the content near them, so an edit moves the chunks around it only.
+
+    Args:
+        data: The file content (bytes or a memory map).
+        start (int): Start offset of the chunk.
+        end (int): End offset of the data.
+
+    Returns:
+        int: End offset of the chunk.
+    """
+    if end - start <= CHUNK_MIN_SIZE:
+        return end
+    average_end: int = min(start + CHUNK_AVERAGE_SIZE, end)
+    max_end: int = min(start + CHUNK_MAX_SIZE, end)
+    gear: list[int] = GEAR_TABLE
+    rolling_hash: int = 0
+    for position, byte in enumerate(data[start + CHUNK_MIN_SIZE:average_end], start + CHUNK_MIN_SIZE + 1):
+        rolling_hash = (rolling_hash >> 1) + gear[byte]
+        if not rolling_hash & CHUNK_HARD_MASK:
+            return position
+    for position, byte in enumerate(data[average_end:max_end], average_end + 1):
+        rolling_hash = (rolling_hash >> 1) + gear[byte]
+        if not rolling_hash & CHUNK_EASY_MASK:
+            return position
+    return max_end
+
+
+def clone_file(source_path: str, destination_path: str) -> None:
+    """Copy file content, by reflink or `copy_file_range` when the filesystem supports it."""
+    with open(source_path, "rb") as source, open(destination_path, "wb") as destination:
+        if tracer is not None:
+            trace_count("files_copied")
+            trace_count("bytes_copied", os.fstat(source.fileno()).st_size)
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+                return
+            except OSError:
+                pass
+        if hasattr(os, "copy_file_range"):
+            try:
+                while os.copy_file_range(source.fileno(), destination.fileno(), 64 * BLOCK_SIZE):
+                    pass
+                return
+            except OSError:
+                source.seek(0)
+                destination.seek(0)
+                destination.truncate()
+        shutil.copyfileobj(source, destination, BLOCK_SIZE)
+
+
+def copy_file(source_path: str, destination_path: str) -> None:
+    """Replace destination with a copy of source.
+
+    The copy is written to a temporary file that replaces the destination, so
+    a destination that is a hard link to an object is never written through.
+    """
+    os.makedirs(os.path.dirname(destination_path) or ".", exist_ok=True)
+    temp_path: str = f"{destination_path}.wit-tmp"
+    if os.path.lexists(temp_path):
+        os.remove(temp_path)
+    clone_file(source_path, temp_path)
+    os.replace(temp_path, destination_path)
 
 
-def get_references_data() -> dict[str, str | None]:
-    """Return the data from references file."""
-    references_data: dict[str, str | None] = {"HEAD": None, 
-                                              "master": None}
+def read_pack_entry_header(pack) -> tuple[int, int, str | None, int]:
+    """Read an entry header from the pack file: (type, size, delta base ID, compressed size)."""
+    entry_type, size = PACK_ENTRY_HEADER.unpack(pack.read(PACK_ENTRY_HEADER.size))
+    base_id: str | None = pack.read(20).hex() if entry_type == PACK_DELTA_ENTRY else None
+    compressed_size: int = struct.unpack(">Q", pack.read(8))[0]
+    return entry_type, size, base_id, compressed_size
+
+
+def get_line_hashes(data: bytes) -> tuple[array, array]:
+    """Return the hashes and the start offsets (with the data size at the end) of the data lines."""
+    hashes: array = array("q")
+    offsets: array = array("q", [0])
+    for line in data.splitlines(keepends=True):
+        hashes.append(hash(line))
+        offsets.append(offsets[-1] + len(line))
+    return hashes, offsets
+
+
+def create_delta(base: bytes, target: bytes) -> bytes:
+    """Return a delta that rebuilds target from base: copy (offset, size) and insert (data) instructions.
+
+    The instructions follow the equal lines found by the diff of the two versions.
+    """
+    base_hashes, base_offsets = get_line_hashes(base)
+    target_hashes, target_offsets = get_line_hashes(target)
+    delta: bytearray = bytearray()
+    target_position: int = 0
+    for base_start, target_start, length in get_matching_blocks(base_hashes, target_hashes):
+        copy_start: int = base_offsets[base_start]
+        copy_end: int = base_offsets[base_start + length]
+        target_copy_start: int = target_offsets[target_start]
+        target_copy_end: int = target_offsets[target_start + length]
+        if base[copy_start:copy_end] != target[target_copy_start:target_copy_end]:
+            # Different lines with the same hash, stored as inserted data.
+            continue
+        if target_copy_start > target_position:
+            delta += DELTA_INSTRUCTION.pack(DELTA_INSERT, 0, target_copy_start - target_position)
+            delta += target[target_position:target_copy_start]
+        if copy_end > copy_start:
+            delta += DELTA_INSTRUCTION.pack(DELTA_COPY, copy_start, copy_end - copy_start)
+        target_position = target_copy_end
+    if len(target) > target_position:
+        delta += DELTA_INSTRUCTION.pack(DELTA_INSERT, 0, len(target) - target_position)
+        delta += target[target_position:]
+    return bytes(delta)
+
+
+def apply_delta(base: bytes, delta: bytes) -> bytes:
+    """Rebuild the target of a delta created by `create_delta`."""
+    target: list[bytes] = []
+    position: int = 0
+    while position < len(delta):
+        instruction, offset, size = DELTA_INSTRUCTION.unpack_from(delta, position)
+        position += DELTA_INSTRUCTION.size
+        if instruction == DELTA_COPY:
+            target.append(base[offset:offset + size])
+        else:
+            target.append(delta[position:position + size])
+            position += size
+    return b"".join(target)
+
+
+def build_trees(files: dict[str, str]) -> dict[str, tuple[str, bytes]]:
+    """Return the Merkle tree of the files: a tree object for every folder.
+
+    A tree object lists the children of the folder sorted by name, one `blob object_id name`
+    or `tree tree_id name` line each, and its ID is the sha1 of `tree\\0` and the list, so a
+    folder has the same ID in every commit where nothing under it changed.
+
+    Args:
+        files (dict[str, str]): File path -> object ID.
+
+    Returns:
+        dict[str, tuple[str, bytes]]: Folder ("" for the root) -> (tree ID, tree object content).
+    """
+    children: dict[str, dict[str, tuple[str, str]]] = {"": {}}
+    for path, object_id in files.items():
+        folder, _, name = path.rpartition("/")
+        children.setdefault(folder, {})[name] = ("blob", object_id)
+    for folder in list(children):
+        while folder and (parent := folder.rpartition("/")[0]) not in children:
+            children[parent] = {}
+            folder = parent
+    trees: dict[str, tuple[str, bytes]] = {}
+    # Deeper folders first, so the IDs of the subtrees are known when their parent is built.
+    for folder in sorted(children, key=lambda folder: folder.count("/") if folder else -1, reverse=True):
+        content: bytes = "".join(f"{kind} {object_id} {name}\n"
+                                 for name, (kind, object_id) in sorted(children[folder].items())).encode()
+        trees[folder] = (hashlib.sha1(b"tree\0" + content).hexdigest(), content)
+        if folder:
+            parent, _, name = folder.rpartition("/")
+            children[parent][name] = ("tree", trees[folder][0])
+    return trees
+
+
+def get_file_stat(file_path: str) -> list[int] | None:
+    """Return [size, mtime_ns, inode] of the file or None if it does not exist."""
     try:
-        with open(os.path.join(BASE_FOLDER_NAME, "references.txt"), "r") as file:
-            file_data: list[str] = file.read().strip().split("\n")
-            for line in file_data:
-                line: list[str, str] = line.split("=")
-                references_data[line[0]] = line[1]
-    except FileNotFoundError:
-        pass
-    return references_data
+        stat: os.stat_result = os.stat(file_path)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    if S_ISDIR(stat.st_mode):
+        return None
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+def update_index_entry(index: dict[str, list], file: str, object_id: str, file_path: str | None = None) -> None:
+    """Set the staged object of the file (and the working tree cache if `file_path` has the same content).
 
+    Args:
+        index (dict[str, list]): The index.
+        file (str): File path relative to the repository.
+        object_id (str): Staged object ID.
+        file_path (str | None, optional): Working tree file with the same content. Defaults to None.
+    """
+    stat: list[int] | None = get_file_stat(file_path) if file_path is not None else None
+    if stat is None:
+        old_entry: list = index.get(file, [None, None, None, None, None])
+        index[file] = [object_id] + old_entry[1:]
+    else:
+        index[file] = [object_id, object_id] + stat
 
-def update_references_file(references_data: dict[str, str]) -> None:
-    """Update references file.
+
+def get_worktree_hash(entry: list, file_path: str, unchanged: bool = False) -> str | None:
+    """Return object ID of a working tree file, hash it only if its stat changed.
 
     Args:
-        references_data (dict): All data: HEAD, master and branches.
+        entry (list): Index entry of the file (the cache is updated in place).
+        file_path (str): Working tree file path.
+        unchanged (bool, optional): The file did not change since its cache was checked,
+            so a cached hash is returned without a stat. Defaults to False.
+
+    Returns:
+        str | None: Object ID, None if the file does not exist.
     """
-    with open(os.path.join(BASE_FOLDER_NAME, "references.txt"), "w") as file:
-        for key, value in references_data.items():
-            file.write(f"{key}={value}\n")
+    return get_worktree_hashes([entry], [file_path], [unchanged])[0]
 
 
-def check_for_commits() -> None:
-    """Raise error if no commits have been made yet."""
-    references_data: dict[str, str | None] = get_references_data()
-    parent: str = references_data["HEAD"]
-    if parent is None:
-        raise FileNotFoundError("No commits have been made yet.")
+def get_worktree_hashes(entries: list[list], file_paths: list[str], unchanged: list[bool]) -> list[str | None]:
+    """Return the object IDs of working tree files (see `get_worktree_hash`), the files whose stat
+    changed are hashed together by `hash_files`.
 
+    Args:
+        entries (list[list]): Index entry of every file (the caches are updated in place).
+        file_paths (list[str]): Working tree file paths.
+        unchanged (list[bool]): For every file, if it did not change since its cache was checked.
+
+    Returns:
+        list[str | None]: Object ID of every file, None if the file does not exist.
+    """
+    object_ids: list[str | None] = []
+    # (number, stat) of the files to hash.
+    changed: list[tuple[int, list[int]]] = []
+    for number, (entry, file_path) in enumerate(zip(entries, file_paths)):
+        if unchanged[number] and entry[1] is not None:
+            object_ids.append(entry[1])
+            continue
+        stat: list[int] | None = get_file_stat(file_path)
+        if stat is None:
+            entry[1:] = [None, None, None, None]
+        elif entry[1] is None or entry[2:] != stat:
+            changed.append((number, stat))
+        object_ids.append(entry[1])
+    if changed:
+        for (number, stat), object_id in zip(changed, hash_files([file_paths[number] for number, _ in changed])):
+            # A file that was removed after its stat is missing.
+            entries[number][1:] = [object_id] + stat if object_id is not None else [None, None, None, None]
+            object_ids[number] = object_id
+    return object_ids
+
+
+class FsmonitorJournal:
+    """The journal of changed paths that `wit watch` appends to.
+
+    The first line is a token that changes whenever a new journal is started,
+    so readers of an older journal know they may have missed changes.
+    """
 
+    def __init__(self, folder: str) -> None:
+        self.folder: str = folder
+        self.token: str = ""
+        self.file: int | None = None
+        self.size: int = 0
+        self.start()
+
+    def start(self) -> None:
+        """Start a new journal with a new token."""
+        self.token = f"{os.getpid()}-{time.time_ns()}"
+        journal_path: str = os.path.join(self.folder, FSMONITOR_JOURNAL_NAME)
+        with open(f"{journal_path}.tmp", "w") as file:
+            file.write(f"{self.token}\n")
+        os.replace(f"{journal_path}.tmp", journal_path)
+        if self.file is not None:
+            os.close(self.file)
+        self.file = os.open(journal_path, os.O_WRONLY | os.O_APPEND)
+        self.size = len(self.token) + 1
+        watcher_path: str = os.path.join(self.folder, FSMONITOR_WATCHER_FILE_NAME)
+        with open(f"{watcher_path}.tmp", "w") as file:
+            file.write(f"{os.getpid()} {self.token}\n")
+        os.replace(f"{watcher_path}.tmp", watcher_path)
+
+    def write(self, lines: list[str]) -> None:
+        """Append lines to the journal in one write (whole lines only)."""
+        if not lines:
+            return
+        data: list[str] = []
+        seen: set[str] = set()
+        for line in lines:
+            if line in seen:
+                continue
+            # A path with a new line can not be written, so readers must scan the tree.
+            data.append(f"{line}\n" if "\n" not in line else "!overflow\n")
+            if line.startswith("!cookie "):
+                # A change after a cookie belongs to the next query, so it is not merged with earlier ones.
+                seen.clear()
+            else:
+                seen.add(line)
+        encoded: bytes = "".join(data).encode(errors="surrogateescape")
+        os.write(self.file, encoded)
+        self.size += len(encoded)
+        if self.size > FSMONITOR_JOURNAL_MAX_SIZE:
+            self.start()
+
+    def close(self) -> None:
+        """Close the journal and remove the watcher file if it is still ours."""
+        os.close(self.file)
+        watcher_path: str = os.path.join(self.folder, FSMONITOR_WATCHER_FILE_NAME)
+        with contextlib.suppress(FileNotFoundError):
+            with open(watcher_path, "r") as file:
+                if file.read().split()[1:] == [self.token]:
+                    os.remove(watcher_path)
+
+
+def watch_inotify(journal: FsmonitorJournal, root: str) -> None:
+    """Write the changes of the working tree to the journal using inotify (Linux).
+
+    Args:
+        journal (FsmonitorJournal): The journal.
+        root (str): The repository root folder.
+
+    Raises:
+        OSError: If inotify is not available.
+    """
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    inotify_fd: int = libc.inotify_init1(os.O_CLOEXEC)
+    if inotify_fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify is not available")
+    cookies_path: str = os.path.join(journal.folder, FSMONITOR_COOKIES_FOLDER_NAME)
+    # Watch descriptor -> folder relative to the repository (None for the cookies folder).
+    folders: dict[int, str | None] = {}
+
+    def add_watch(path: str, folder: str | None) -> None:
+        watch_descriptor: int = libc.inotify_add_watch(inotify_fd, os.fsencode(path), INOTIFY_MASK)
+        if watch_descriptor >= 0:
+            folders[watch_descriptor] = folder
+        elif ctypes.get_errno() not in (errno.ENOENT, errno.ENOTDIR):
+            # Changes in a folder that is not watched would be lost (e.g. too many watches).
+            raise OSError(ctypes.get_errno(), f"can not watch `{path}`")
+
+    def add_tree(folder: str) -> None:
+        # The folder is watched before it is listed, so no new sub folder is missed.
+        folders_to_add: list[str] = [folder]
+        while folders_to_add:
+            folder = folders_to_add.pop()
+            add_watch(os.path.join(root, folder), folder)
+            with contextlib.suppress(FileNotFoundError, NotADirectoryError), os.scandir(os.path.join(root, folder)) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False) and not (folder == "" and entry.name == BASE_FOLDER_NAME):
+                        folders_to_add.append(f"{folder}/{entry.name}" if folder else entry.name)
+
+    def remove_tree(folder: str) -> None:
+        for watch_descriptor, path in list(folders.items()):
+            if path is not None and (path == folder or path.startswith(f"{folder}/")):
+                libc.inotify_rm_watch(inotify_fd, watch_descriptor)
+                del folders[watch_descriptor]
+
+    try:
+        add_watch(cookies_path, None)
+        add_tree("")
+        while True:
+            buffer: bytes = os.read(inotify_fd, 64 * 1024)
+            lines: list[str] = []
+            position: int = 0
+            while position < len(buffer):
+                watch_descriptor, mask, _, length = INOTIFY_EVENT.unpack_from(buffer, position)
+                name: str = os.fsdecode(buffer[position + INOTIFY_EVENT.size:position + INOTIFY_EVENT.size + length].rstrip(b"\0"))
+                position += INOTIFY_EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    lines.append("!overflow")
+                    continue
+                if watch_descriptor not in folders:
+                    continue
+                folder: str | None = folders[watch_descriptor]
+                if mask & IN_IGNORED:
+                    del folders[watch_descriptor]
+                    continue
+                if folder is None:
+                    if mask & IN_CREATE:
+                        lines.append(f"!cookie {name}")
+                    continue
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    if folder == "":
+                        lines.append("!overflow")
+                    continue
+                if folder == "" and name == BASE_FOLDER_NAME:
+                    continue
+                path: str = f"{folder}/{name}" if folder else name
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        add_tree(path)
+                    elif mask & IN_MOVED_FROM:
+                        remove_tree(path)
+                    path += "/"
+                lines.append(path)
+            journal.write(lines)
+    finally:
+        os.close(inotify_fd)
+
+
+def get_tree_stats(root: str) -> dict[str, tuple[int, int, int]]:
+    """Return relative path -> (size, mtime_ns, inode) of every working tree file."""
+    stats: dict[str, tuple[int, int, int]] = {}
+    for file in walk_worktree(root):
+        with contextlib.suppress(OSError):
+            stat: os.stat_result = os.lstat(os.path.join(root, file))
+            stats[file] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+    return stats
+
+
+def watch_polling(journal: FsmonitorJournal, root: str) -> None:
+    """Write the changes of the working tree to the journal by comparing stats of the whole tree."""
+    cookies_path: str = os.path.join(journal.folder, FSMONITOR_COOKIES_FOLDER_NAME)
+    stats: dict[str, tuple[int, int, int]] = get_tree_stats(root)
+    while True:
+        time.sleep(FSMONITOR_POLL_INTERVAL)
+        # Cookies are listed before the scan, so the changes made before a cookie are in the scan.
+        cookies: list[str] = os.listdir(cookies_path)
+        new_stats: dict[str, tuple[int, int, int]] = get_tree_stats(root)
+        lines: list[str] = [file for file in stats.keys() | new_stats.keys() if stats.get(file) != new_stats.get(file)]
+        journal.write(lines + [f"!cookie {cookie}" for cookie in cookies])
+        for cookie in cookies:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(cookies_path, cookie))
+        stats = new_stats
+
+
+@traced
 def create_files_list(folder: str, ignore: str = None) -> list[str]:
     """Return list with all sub files in the folder."""
     result: list[str] = []
     for dir, _, files in os.walk(folder):
+        trace_count("directories_walked")
         if ignore is None or not dir.startswith(ignore):
             for file in files:
-                result.append(os.path.relpath(os.path.join(dir, file), folder))
+                result.append(os.path.relpath(os.path.join(dir, file), folder).replace(os.sep, "/"))
+    trace_count("files_walked", len(result))
     return result
 
 
-def get_short_commit_name(commit_name: str) -> str:
-    """Return first 6 letters in the commit ID."""
-    return commit_name[:6]
+def compile_ignore_pattern(pattern: str) -> str:
+    """Return a regular expression for one `.witignore` pattern (gitignore syntax, without `!` and the trailing `/`).
 
+    A pattern with a `/` is matched against the path relative to the folder of the
+    ignore file, other patterns are matched against the name at any depth.
+    `*`, `?` and `[...]` do not match `/`, `**` matches any number of folders.
+    """
+    anchored: bool = "/" in pattern
+    pattern = pattern.removeprefix("/")
+    regex: list[str] = [] if anchored else ["(?:.*/)?"]
+    position: int = 0
+    while position < len(pattern):
+        character: str = pattern[position]
+        if pattern.startswith("**/", position) and (position == 0 or pattern[position - 1] == "/"):
+            regex.append("(?:.*/)?")
+            position += 3
+        elif pattern.startswith("/**", position) and position + 3 == len(pattern):
+            regex.append("/.*")
+            position += 3
+        elif character == "*":
+            regex.append("[^/]*")
+            position += 1
+            while position < len(pattern) and pattern[position] == "*":
+                position += 1
+        elif character == "?":
+            regex.append("[^/]")
+            position += 1
+        elif character == "[" and (end := pattern.find("]", position + 2)) != -1:
+            characters: str = pattern[position + 1:end]
+            if characters[0] in "!^":
+                characters = "^" + characters[1:]
+            regex.append("(?!/)[" + characters.replace("\\", "\\\\").replace("[", "\\[") + "]")
+            position = end + 1
+        elif character == "\\" and position + 1 < len(pattern):
+            regex.append(re.escape(pattern[position + 1]))
+            position += 2
+        else:
+            regex.append(re.escape(character))
+            position += 1
+    return "".join(regex)
 
-def get_status(source_path: str = None, stage_path: str = None, commit_path: str = None) -> dict[str, list[str] | str | None]:
-    """Return the current state of your wit working directory and staging area.
 
-    Args:
-        source_path (str, optional): Source folder path. Defaults to None.
-        stage_path (str, optional): Stage folder path. Defaults to None.
-        commit_path (str, optional): Last commit folder path. Defaults to None.
+class IgnoreRules:
+    """The `.witignore` files of a working tree, compiled when they are first needed.
 
-    Returns:
-        dict[str, list[str] | str | None]: Status.
+    Every folder may have a `.witignore` file with gitignore patterns: `#` comments,
+    `!` to include again, a trailing `/` for folders only, and `*`, `?`, `[...]`, `**`.
+    The last pattern that matches a path decides, and the ignore files of deeper
+    folders come before the ones of their parents. Files in an ignored folder are
+    ignored (a `!` pattern can not include them again), so ignored folders are not walked.
     """
-    find_wit_folder()
-    references_data: dict[str, str | None] = get_references_data()
-    parent: str = references_data["HEAD"]
-    source_path: str = source_path or os.getcwd()
-    stage_path: str = stage_path or os.path.join(source_path, BASE_FOLDER_NAME, SUB_FOLDER_NAMES["staging_area"])
-    commit_path: str = commit_path or os.path.join(source_path, BASE_FOLDER_NAME, SUB_FOLDER_NAMES["images"], parent or "")
-    all_status: dict[str, list[str] | str | None] = {
-                  "Current commit:": parent, 
-                  "Changes to be committed:": [], 
-                  "Changes not staged for commit:": [], 
-                  "Untracked files:": [], 
-                  }
-    source_files: list[str] = create_files_list(source_path, os.path.join(source_path, BASE_FOLDER_NAME))
-    stage_files: list[str] = create_files_list(stage_path)
-    commit_files: list[str] = create_files_list(commit_path)
-    for file in stage_files:
-        if file not in commit_files:
-            all_status["Changes to be committed:"].append(file)
-        elif not filecmp.cmp(os.path.join(stage_path, file), os.path.join(commit_path, file)):
-                all_status["Changes to be committed:"].append(file)
-        if file in source_files:
-            if not filecmp.cmp(os.path.join(source_path, file), os.path.join(stage_path, file)):
-                all_status["Changes not staged for commit:"].append(file)
-            source_files.remove(file)
-    all_status["Untracked files:"] = source_files
-    return all_status
-
-
-def create_commit_file_data(folder_path: str, parent: str, message: str, second_parent: str | None = None) -> None:
-    """Write commit data file.
+
+    def __init__(self, root: str) -> None:
+        self.root: str = root
+        # Folder -> groups of consecutive patterns with the same sign: (include again,
+        # regular expression of all the patterns, regular expression of the patterns that also match files).
+        self.folders: dict[str, list[tuple[bool, re.Pattern, re.Pattern | None]]] = {}
+        self.ignored_folders: dict[str, bool] = {}
+
+    def load(self, folder: str, exists: bool = True) -> list[tuple[bool, re.Pattern, re.Pattern | None]]:
+        """Compile the `.witignore` file of the folder ("" for the root).
+
+        Args:
+            folder (str): Folder relative to the root.
+            exists (bool, optional): False if it is known that there is no ignore file. Defaults to True.
+        """
+        patterns: list[tuple[bool, str, bool]] = []
+        if exists:
+            trace_count("metadata_files_opened")
+            try:
+                with open(os.path.join(self.root, folder, IGNORE_FILE_NAME), "r", encoding="utf-8") as file:
+                    lines: list[str] = file.read().splitlines()
+            except (FileNotFoundError, NotADirectoryError):
+                lines = []
+            for line in lines:
+                while line.endswith(" ") and not line.endswith("\\ "):
+                    line = line[:-1]
+                if not line or line.startswith("#"):
+                    continue
+                negate: bool = line.startswith("!")
+                line = line.removeprefix("!")
+                folder_only: bool = line.endswith("/")
+                line = line.rstrip("/")
+                if line:
+                    patterns.append((negate, compile_ignore_pattern(line), folder_only))
+        groups: list[tuple[bool, re.Pattern, re.Pattern | None]] = []
+        start: int = 0
+        for end in range(1, len(patterns) + 1):
+            if end == len(patterns) or patterns[end][0] != patterns[start][0]:
+                group: list[tuple[bool, str, bool]] = patterns[start:end]
+                file_patterns: list[str] = [regex for _, regex, folder_only in group if not folder_only]
+                groups.append((group[0][0], re.compile("|".join(regex for _, regex, _ in group)),
+                               re.compile("|".join(file_patterns)) if file_patterns else None))
+                start = end
+        self.folders[folder] = groups
+        return groups
+
+    def match(self, path: str, is_folder: bool) -> bool:
+        """Return True if the patterns ignore the path (its parent folders are not checked)."""
+        folder: str = path
+        while folder:
+            folder = folder.rpartition("/")[0]
+            groups = self.folders.get(folder)
+            if groups is None:
+                groups = self.load(folder)
+            relative_path: str = path[len(folder) + 1:] if folder else path
+            for negate, folder_regex, file_regex in reversed(groups):
+                regex: re.Pattern | None = folder_regex if is_folder else file_regex
+                if regex is not None and regex.fullmatch(relative_path):
+                    return not negate
+        return False
+
+    def is_ignored(self, path: str, is_folder: bool = False) -> bool:
+        """Return True if the path or one of its parent folders is ignored.
+
+        Args:
+            path (str): Path relative to the root ("/" separated).
+            is_folder (bool, optional): The path is a folder. Defaults to False.
+        """
+        parent: str = path.rpartition("/")[0]
+        if parent:
+            if parent not in self.ignored_folders:
+                self.ignored_folders[parent] = self.is_ignored(parent, True)
+            if self.ignored_folders[parent]:
+                return True
+        return self.match(path, is_folder)
+
+
+@traced
+def walk_worktree(root: str, folder: str = ".", ignore_rules: IgnoreRules | None = None) -> list[str]:
+    """Return the working tree files under the folder, without the `.wit` folder and ignored files.
+
+    Ignored folders are removed from the walk in place, so they are never listed.
 
     Args:
-        folder_path (str): Commit name with path.
-        parent (str): Parent of commit.
-        message (str): Commit description.
-        second_parent (str, optional): Second parent. Defaults to None.
+        root (str): The repository root folder.
+        folder (str, optional): Folder to walk, relative to the root. Defaults to ".".
+        ignore_rules (IgnoreRules | None, optional): The `.witignore` rules. Defaults to None.
 
     Returns:
-        None.
+        list[str]: File paths relative to the root ("/" separated).
     """
-    if second_parent is not None:
-        parent += f", {second_parent}"
-    with open(f"{folder_path}.txt", "w") as file:
-        file.write(f"""parent={parent}\ndate={datetime.now():%a %b %d %H:%M:%S %Y} {time.strftime("%z")}\nmessage={message}""")
+    result: list[str] = []
+    if ignore_rules is not None and folder != "." and ignore_rules.is_ignored(folder, True):
+        return result
+    for dir, dirs, files in os.walk(os.path.normpath(os.path.join(root, folder))):
+        trace_count("directories_walked")
+        relative_folder: str = os.path.relpath(dir, root).replace(os.sep, "/")
+        prefix: str = "" if relative_folder == "." else f"{relative_folder}/"
+        if not prefix and BASE_FOLDER_NAME in dirs:
+            dirs.remove(BASE_FOLDER_NAME)
+        if ignore_rules is not None:
+            # The walk lists the folder, so a missing ignore file is not opened.
+            if prefix.rstrip("/") not in ignore_rules.folders:
+                ignore_rules.load(prefix.rstrip("/"), IGNORE_FILE_NAME in files)
+            dirs[:] = [name for name in dirs if not ignore_rules.match(prefix + name, True)]
+            result.extend(prefix + name for name in files if not ignore_rules.match(prefix + name, False))
+        else:
+            result.extend(prefix + name for name in files)
+    trace_count("files_walked", len(result))
+    return result
 
-    
-def commit(message: str, second_parent: str | None = None) -> None:
-    """Commit the changes to images folder.
 
-    Args:
-        message (str): Commit description.
-        second_parent (str | None, optional): Second parent. Defaults to None.
+def parse_date(text: str) -> int:
+    """Return the unix timestamp of a date (`YYYY-MM-DD[ HH:MM[:SS]]`, in local time, or a unix timestamp).
 
     Raises:
-        FileExistsError: If nothing added to commit or commit already exist.
+        ValueError: If the date can not be parsed.
     """
-    find_wit_folder()
-    source_path: str = os.path.abspath(os.path.join(BASE_FOLDER_NAME, SUB_FOLDER_NAMES["staging_area"]))
-    destination_path: str = os.path.abspath(os.path.join(BASE_FOLDER_NAME, SUB_FOLDER_NAMES["images"]))
-    references_data: dict[str, str | None] = get_references_data()
-    parent: str = references_data["HEAD"]
-    status: dict[str, list[str] | str | None] = get_status()
-    if status["Current commit:"] is None and status["Changes to be committed:"] == []:
-        raise FileExistsError("Nothing added to commit (use `wit add` to track).")
-    if status["Changes to be committed:"] == []:
-        raise FileExistsError("Image already exist.")
-    folder_name: str = get_new_folder_name()
-    folder_path: str = os.path.join(destination_path, folder_name)
-    create_commit_file_data(folder_path, parent, message, second_parent)
-    shutil.copytree(source_path, folder_path, dirs_exist_ok=True)
-    references_data["HEAD"] = folder_name
-    current_branch: str = get_activated_branch()
-    if references_data.get(current_branch, "") == parent:
-        references_data[current_branch] = folder_name
-    update_references_file(references_data)
-    print(f"New commit created: {get_short_commit_name(folder_name)}")
-
-
-def print_status() -> None:
-    """Prints the current state of your wit working directory and staging area."""
-    status_data: dict[str, list[str] | str | None] = get_status()
-    for state, data in status_data.items():
-        print(state)
-        if isinstance(data, list) and data != []:
-            for file in data:
-                print(f"\t{os.path.relpath(file)}")
-        else:
-            print(f"\t{data or None}")
-        print()
+    if text.isdigit():
+        return int(text)
+    try:
+        return int(datetime.fromisoformat(text).timestamp())
+    except ValueError:
+        raise ValueError(f"Invalid date `{text}` (use YYYY-MM-DD[ HH:MM[:SS]]).")
 
 
-def update_stage_area(source_path: str) -> None:
-    """Replace current files in stage area with updated files.
+def get_short_commit_name(commit_name: str) -> str:
+    """Return first 6 letters in the commit ID."""
+    return commit_name[:6]
 
-    Args:
-        source_path (str): Path of new content.
-    """
-    staging_area: str = os.path.join(BASE_FOLDER_NAME, SUB_FOLDER_NAMES["staging_area"])
-    shutil.rmtree(staging_area)
-    shutil.copytree(source_path, staging_area)
+
+def remove_file(file_path: str, root: str) -> None:
+    """Remove a file and the parent folders that become empty (up to root)."""
+    if os.path.lexists(file_path):
+        os.remove(file_path)
+    folder: str = os.path.dirname(file_path)
+    while os.path.normpath(folder) != os.path.normpath(root) and os.path.isdir(folder) and not os.listdir(folder):
+        os.rmdir(folder)
+        folder = os.path.dirname(folder)
+
+
+def get_stage_changes(index: dict[str, list], manifest: dict[str, str]) -> dict[str, str | None]:
+    """Return the changes that make the stage match the manifest (None for files to remove)."""
+    changes: dict[str, str | None] = {file: None for file in index if file not in manifest}
+    changes.update(manifest)
+    return changes
 
 
 def check_for_changes(status_data: dict[str, list[str] | str | None]) -> None:
@@ -258,266 +944,2581 @@ def check_for_changes(status_data: dict[str, list[str] | str | None]) -> None:
         raise ValueError("ERROR! \nThere are files that have not yet been add/commit. \nPlease run add/commit commands and try again.")
 
 
-def checkout(id: str, ignore: bool = False) -> None:
-    """Updates files in the working tree to match the version in the id.
+def index_file_lines(file_path: str) -> tuple[array, array]:
+    """Return the hashes of the file lines and the offsets where the lines start.
+
+    Only these two compact arrays are kept in memory, never the lines themselves.
 
     Args:
-        id (str): The id or name of commit.
-        ignore (bool, optional): Whether to check if there are changes or not (used in merge commends). Defaults to False.
+        file_path (str): File path.
+
+    Returns:
+        tuple[array, array]: Line hashes, line offsets (with the file size at the end).
     """
-    find_wit_folder()
-    check_for_commits()
-    id = id.lower()
-    references_data: dict[str, str | None] = get_references_data()
-    if id in references_data.keys():
-        update_activated_branch_file(id)
-        id = references_data[id]
-    else:
-        update_activated_branch_file("")
-    source_path: str = os.path.abspath(os.path.join(BASE_FOLDER_NAME, SUB_FOLDER_NAMES["images"], id))
-    destination_path: str = os.getcwd()
-    status_data: dict[str, list[str] | str | None] = get_status()
-    if not ignore:
-        check_for_changes(status_data)
-    base_folder: str = os.path.join(destination_path, BASE_FOLDER_NAME)
-    for dir, _, files in os.walk(destination_path, topdown=False):
-        if not dir.startswith(base_folder):
-            for file in files:
-                file_in_stage = os.path.join(dir, file)
-                if os.path.relpath(file_in_stage, destination_path) not in status_data["Untracked files:"]:
-                    os.remove(file_in_stage)
-            if len(os.listdir(dir)) == 0 and dir != destination_path:
-                os.rmdir(dir)
-    shutil.copytree(source_path, destination_path, dirs_exist_ok=True)
-    references_data["HEAD"] = id
-    update_references_file(references_data)
-    update_stage_area(source_path)
-
-
-def get_parent(commit: str) -> list[str]:
-    """Return commit parent\s."""
-    try:
-        with open(os.path.join(BASE_FOLDER_NAME, SUB_FOLDER_NAMES["images"], f"{commit}.txt"), "r") as file:
-            file_data: list = file.read().split("\n")
-            return file_data[0].removeprefix("parent=").split(", ")
-    except FileNotFoundError:
-        raise FileNotFoundError("Commit data not found.")
+    hashes: array = array("q")
+    offsets: array = array("q", [0])
+    with open(file_path, "rb") as file:
+        for line in file:
+            hashes.append(hash(line))
+            offsets.append(offsets[-1] + len(line))
+    return hashes, offsets
 
 
-def get_current_commit_tree(head: str, distance: int = 0) -> list[tuple[str, str, int]]:
-    """Get current commit tree.
+def find_middle_snake(a: array, a_start: int, a_end: int, b: array, b_start: int, b_end: int) -> tuple[int, int, int, int] | None:
+    """Find the middle snake of the shortest edit script between a[a_start:a_end] and b[b_start:b_end] (Myers).
+
+    Returns:
+        tuple[int, int, int, int] | None: Snake start and end (x, y, x, y) relative to the starts,
+        None if the edit distance is larger than `DIFF_MAX_COST`.
+    """
+    n: int = a_end - a_start
+    m: int = b_end - b_start
+    delta: int = n - m
+    odd: bool = delta % 2 == 1
+    max_d: int = min((n + m + 1) // 2, DIFF_MAX_COST)
+    offset: int = max_d + 1
+    forward: list[int] = [0] * (2 * max_d + 3)
+    backward: list[int] = [0] * (2 * max_d + 3)
+    for d in range(max_d + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and forward[offset + k - 1] < forward[offset + k + 1]):
+                x: int = forward[offset + k + 1]
+            else:
+                x = forward[offset + k - 1] + 1
+            y: int = x - k
+            x_start, y_start = x, y
+            while x < n and y < m and a[a_start + x] == b[b_start + y]:
+                x += 1
+                y += 1
+            forward[offset + k] = x
+            if odd and -(d - 1) <= delta - k <= d - 1 and x + backward[offset + delta - k] >= n:
+                return x_start, y_start, x, y
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and backward[offset + k - 1] < backward[offset + k + 1]):
+                x = backward[offset + k + 1]
+            else:
+                x = backward[offset + k - 1] + 1
+            y = x - k
+            x_start, y_start = x, y
+            while x < n and y < m and a[a_end - 1 - x] == b[b_end - 1 - y]:
+                x += 1
+                y += 1
+            backward[offset + k] = x
+            if not odd and -d <= delta - k <= d and forward[offset + delta - k] + x >= n:
+                return n - x, m - y, n - x_start, m - y_start
+    return None
 
-    Args:
-        head (str): Head of tree.
-        distance (int, optional): distance between head and parent. Defaults to 0.
+
+def get_matching_blocks(a: array, b: array) -> list[tuple[int, int, int]]:
+    """Return the blocks of equal lines of the shortest diff between a and b.
 
     Returns:
-        list[tuple[str, str, int]]: Tree of commits(commit, parent, distance).
+        list[tuple[int, int, int]]: (a start, b start, length) blocks, ending with (len(a), len(b), 0).
     """
-    commit_tree: list[tuple[str, str, int]] = []
-    file: str = head
-    while file != "None":
-        parent: list[str] = get_parent(file)
-        if len(parent) > 1:
-            commit_tree.append((file, parent[1], distance))
-            commit_tree.extend(get_current_commit_tree(parent.pop(1), distance))
-        commit_tree.append((file, parent[0], distance))
-        file = parent[0]
-        distance += 1
-    return commit_tree
-
-
-def get_all_commit_tree() -> list[tuple[str, str, int]]:
-    """Get all trees of all commits.
+    blocks: list[tuple[int, int, int]] = []
+    regions: list[tuple[int, int, int, int]] = [(0, len(a), 0, len(b))]
+    while regions:
+        a_start, a_end, b_start, b_end = regions.pop()
+        prefix: int = 0
+        while a_start + prefix < a_end and b_start + prefix < b_end and a[a_start + prefix] == b[b_start + prefix]:
+            prefix += 1
+        if prefix:
+            blocks.append((a_start, b_start, prefix))
+            a_start += prefix
+            b_start += prefix
+        suffix: int = 0
+        while a_start < a_end - suffix and b_start < b_end - suffix and a[a_end - 1 - suffix] == b[b_end - 1 - suffix]:
+            suffix += 1
+        if suffix:
+            blocks.append((a_end - suffix, b_end - suffix, suffix))
+            a_end -= suffix
+            b_end -= suffix
+        if a_start == a_end or b_start == b_end:
+            continue
+        snake: tuple[int, int, int, int] | None = find_middle_snake(a, a_start, a_end, b, b_start, b_end)
+        if snake is None:
+            # Too different, the whole region is treated as changed.
+            continue
+        x_start, y_start, x_end, y_end = snake
+        if x_end > x_start:
+            blocks.append((a_start + x_start, b_start + y_start, x_end - x_start))
+        regions.append((a_start, a_start + x_start, b_start, b_start + y_start))
+        regions.append((a_start + x_end, a_end, b_start + y_end, b_end))
+    blocks.sort()
+    blocks.append((len(a), len(b), 0))
+    return blocks
+
+
+def find_sync_regions(base: array, current: array, other: array) -> list[tuple[int, int, int, int, int, int]]:
+    """Return the regions where the base, current and other files all match.
 
     Returns:
-        list[tuple[str, str, int]]: Trees of commits(commit, parent, distance=0).
+        list[tuple[int, int, int, int, int, int]]: (base start, base end, current start, current end,
+        other start, other end) regions, ending with an empty region at the end of the files.
     """
-    dir: str = os.path.join(os.getcwd(), BASE_FOLDER_NAME, SUB_FOLDER_NAMES["images"])
-    commit_tree: list[tuple[str, str, int]] = []
-    for file in os.listdir(dir):
-        if os.path.isdir(os.path.join(dir, file)):
-            parent = get_parent(file)
-            if len(parent) > 1:
-                commit_tree.append((file, parent[1], 0))
-            commit_tree.append((file, parent[0], 0))
-    return commit_tree
+    current_blocks: list[tuple[int, int, int]] = get_matching_blocks(base, current)
+    other_blocks: list[tuple[int, int, int]] = get_matching_blocks(base, other)
+    regions: list[tuple[int, int, int, int, int, int]] = []
+    current_index: int = 0
+    other_index: int = 0
+    while current_index < len(current_blocks) - 1 and other_index < len(other_blocks) - 1:
+        base_current, current_start, current_length = current_blocks[current_index]
+        base_other, other_start, other_length = other_blocks[other_index]
+        start: int = max(base_current, base_other)
+        end: int = min(base_current + current_length, base_other + other_length)
+        if start < end:
+            regions.append((start, end,
+                            current_start + start - base_current, current_start + end - base_current,
+                            other_start + start - base_other, other_start + end - base_other))
+        if base_current + current_length < base_other + other_length:
+            current_index += 1
+        else:
+            other_index += 1
+    regions.append((len(base), len(base), len(current), len(current), len(other), len(other)))
+    return regions
 
 
-def show_graph(all: bool = False) -> None:
-    """Show commit graph.
+def merge_regions(base: array, current: array, other: array) -> Iterator[tuple[str, int, int, int, int]]:
+    """Yield the regions of a three way merge (diff3).
 
-    Args:
-        all (bool, optional): If True show all commits trees. Defaults to False.
+    Yields:
+        Iterator[tuple[str, int, int, int, int]]: ("current", start, end, 0, 0), ("other", start, end, 0, 0) or
+        ("conflict", current start, current end, other start, other end).
     """
-    find_wit_folder()
-    check_for_commits()
-    references_data: dict[str, str | None] = get_references_data()
-    head: str = references_data["HEAD"]
-    if all:
-        all_commits_and_parent: list[tuple[str, str], int] = get_all_commit_tree()
-    else:
-        all_commits_and_parent: list[tuple[str, str, int]] = get_current_commit_tree(head)
-    dot = graphviz.Digraph(directory=os.path.abspath(os.path.join(BASE_FOLDER_NAME, "graphs")))
-    dot.attr(rankdir="RL")
-    dot.attr("node", style="filled", color="Aqua", shape="circle")
-    dot.attr("edge", style="bold")
-    all_commit: set[str] = set()
-    for commit, parent, _ in all_commits_and_parent:
-        dot.node(commit, commit[:6])
-        all_commit.add(commit)
-        if parent != "None":
-            dot.node(parent, parent[:6])
-            dot.edge(commit, parent)
-    for name in references_data.keys():
-        if references_data[name] in all_commit:
-            dot.node(name, "", style="invis")
-            dot.edge(name, references_data[name], label=name)
-    dot.view()
-
-
-def branch(name: str) -> None:
-    """Create a branch."""
-    find_wit_folder()
-    name = name.lower()
-    references_data: dict[str, str | None] = get_references_data()
-    if name in references_data.keys() or \
-       name in os.listdir(os.path.join(BASE_FOLDER_NAME, SUB_FOLDER_NAMES["images"])):
-        print("The branch name already taken.\nPlease try different name.")
-        return
-    references_data[name] = references_data["HEAD"]
-    update_references_file(references_data)
-    print(f"New branch created: `{name}`.\nUse `checkout {name}` to activate.")
+    base_position: int = 0
+    current_position: int = 0
+    other_position: int = 0
+    for base_start, base_end, current_start, current_end, other_start, other_end in find_sync_regions(base, current, other):
+        base_lines: array = base[base_position:base_start]
+        current_lines: array = current[current_position:current_start]
+        other_lines: array = other[other_position:other_start]
+        if base_lines or current_lines or other_lines:
+            current_changed: bool = current_lines != base_lines
+            other_changed: bool = other_lines != base_lines
+            if current_changed and other_changed and current_lines != other_lines:
+                yield "conflict", current_position, current_start, other_position, other_start
+            elif other_changed and not current_changed:
+                yield "other", other_position, other_start, 0, 0
+            else:
+                yield "current", current_position, current_start, 0, 0
+        if current_end > current_start:
+            yield "current", current_start, current_end, 0, 0
+        base_position, current_position, other_position = base_end, current_end, other_end
 
 
-def file_lines_generator(file_path: str) -> Iterator[str]:
-    """Yield lines from file.
+def copy_lines(source, offsets: array, start: int, end: int, destination) -> bytes:
+    """Copy lines [start, end) from the source file to the destination file.
 
-    Args:
-        file_path (str): File path.
-
-    Yields:
-        Iterator[str]: Line.
+    Returns:
+        bytes: The last copied byte (b"" if nothing was copied).
     """
-    try:
-        # utf-8 or cp862 and still sometimes there are Errors.
-        with open(file_path, "r", encoding="utf-8") as file:
-            file: list[str] = file.readlines()
-        for line in file:
-            yield line
-    except FileNotFoundError:
-        yield ""
+    position: int = offsets[start]
+    end_position: int = offsets[end]
+    last_byte: bytes = b""
+    source.seek(position)
+    while position < end_position:
+        block: bytes = source.read(min(BLOCK_SIZE, end_position - position))
+        destination.write(block)
+        position += len(block)
+        last_byte = block[-1:]
+    return last_byte
+
 
+@traced
+def merge_files_by_lines(current_file_path: str, merge_file_path: str, parent_file_path: str, output_path: str, merge_name: str = "merge") -> int:
+    """Merge two files into one version by a three way diff of their lines (diff3).
 
-def merge_files_by_lines(current_file_path: str, merge_file_path: str, parent_file_path: str, last_commit: str) -> None:
-    """Merge two files into one version by compare lines.
+    The output is written while the regions are merged, conflicting regions are
+    written between conflict markers.
 
     Args:
         current_file_path (str): The current file.
         merge_file_path (str): The file to merge into current file.
         parent_file_path (str): The common base file for merge and current.
-        last_commit (str): The last commit id.
+        output_path (str): Where to write the merged file.
+        merge_name (str, optional): Name of the merged version in the conflict markers. Defaults to "merge".
+
+    Returns:
+        int: Number of conflicts.
     """
-    current_file: Iterator[str] = file_lines_generator(current_file_path)
-    merge_file: Iterator[str] = file_lines_generator(merge_file_path)
-    parent_file: Iterator[str] = file_lines_generator(parent_file_path)
-    fixed_file: str = ""
-    for merge_file_line in merge_file:
+    current_lines, current_offsets = index_file_lines(current_file_path)
+    merge_lines, merge_offsets = index_file_lines(merge_file_path)
+    parent_lines, _ = index_file_lines(parent_file_path)
+    conflicts: int = 0
+    with open(current_file_path, "rb") as current_file, open(merge_file_path, "rb") as merge_file, \
+         open(output_path, "wb") as output:
+        for kind, start, end, other_start, other_end in merge_regions(parent_lines, current_lines, merge_lines):
+            if kind == "current":
+                copy_lines(current_file, current_offsets, start, end, output)
+            elif kind == "other":
+                copy_lines(merge_file, merge_offsets, start, end, output)
+            else:
+                conflicts += 1
+                output.write(b"<<<<<<< HEAD\n")
+                if copy_lines(current_file, current_offsets, start, end, output) not in (b"", b"\n"):
+                    output.write(b"\n")
+                output.write(b"=======\n")
+                if copy_lines(merge_file, merge_offsets, other_start, other_end, output) not in (b"", b"\n"):
+                    output.write(b"\n")
+                output.write(f">>>>>>> {merge_name}\n".encode())
+    return conflicts
+
+
+def is_text_file(file_path: str) -> bool:
+    """Return True if the first line of the file is UTF-8 text (the file is merged by lines)."""
+    try:
+        with open(file_path, "r", encoding="utf-8") as file:
+            file.readline()
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def iter_records(run: mmap.mmap) -> Iterator[bytes]:
+    """Yield the 20 byte records of a sorted file of object IDs (see `ObjectMarks`)."""
+    for offset in range(0, len(run), 20):
+        yield run[offset:offset + 20]
+
+
+class ObjectMarks:
+    """The object IDs that `gc` marks as used, in a bounded amount of memory.
+
+    Up to `GC_MARKS_IN_MEMORY` IDs are kept in a set. When it is full, they are written sorted
+    as 20 byte records to a file in the folder, and looked up there by a binary search on a memory
+    map. When there are more than `GC_MARKS_MAX_FILES` files they are merged into one, so a lookup
+    reads a few files.
+    """
+
+    def __init__(self, folder: str) -> None:
+        self.folder: str = folder
+        self.limit: int = GC_MARKS_IN_MEMORY
+        self.recent: set[bytes] = set()
+        self.runs: list[tuple[str, mmap.mmap]] = []
+        self.files_written: int = 0
+
+    def __contains__(self, object_id: str) -> bool:
+        return self.contains(bytes.fromhex(object_id))
+
+    def contains(self, key: bytes) -> bool:
+        """Return True if the binary object ID is marked."""
+        if key in self.recent:
+            return True
+        for _, run in self.runs:
+            low, high = 0, len(run) // 20
+            while low < high:
+                middle: int = (low + high) // 2
+                record: bytes = run[middle * 20:middle * 20 + 20]
+                if record == key:
+                    return True
+                if record < key:
+                    low = middle + 1
+                else:
+                    high = middle
+        return False
+
+    def add(self, object_id: str) -> None:
+        """Mark an object ID."""
+        key: bytes = bytes.fromhex(object_id)
+        if self.contains(key):
+            return
+        self.recent.add(key)
+        if len(self.recent) >= self.limit:
+            self.write_run(sorted(self.recent))
+            self.recent.clear()
+            if len(self.runs) > GC_MARKS_MAX_FILES:
+                runs: list[tuple[str, mmap.mmap]] = self.runs
+                self.runs = []
+                self.write_run(heapq.merge(*(iter_records(run) for _, run in runs)))
+                for path, run in runs:
+                    run.close()
+                    os.remove(path)
+
+    def update(self, object_ids: Iterable[str]) -> None:
+        """Mark object IDs."""
+        for object_id in object_ids:
+            self.add(object_id)
+
+    def write_run(self, keys: Iterable[bytes]) -> None:
+        """Write sorted binary object IDs to a new file and map it."""
+        path: str = os.path.join(self.folder, f"marks-{self.files_written}")
+        self.files_written += 1
+        with open(path, "wb") as file:
+            for key in keys:
+                file.write(key)
+        trace_count("gc_mark_files_written")
+        with open(path, "rb") as file:
+            self.runs.append((path, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)))
+
+    def close(self) -> None:
+        """Close the mapped files (the caller removes the folder)."""
+        for _, run in self.runs:
+            run.close()
+        self.runs = []
+
+
+class Repository:
+    """A wit repository.
+
+    The `.wit` folder is found once, and the references, the activated branch, the commit
+    details, the commit graph and the pack indexes are read when first needed and kept (they
+    are updated when the repository writes them), so many commands can run on one object.
+    Paths are resolved from the repository root, the current directory is never changed.
+    """
+
+    def __init__(self, path: str = ".") -> None:
+        """Open the repository that contains path.
+
+        Args:
+            path (str, optional): A folder in the repository. Defaults to ".".
+
+        Raises:
+            FileNotFoundError: If there is no `.wit` folder in path or any of its parent folders.
+        """
+        self.root: str = self.find_root(path)
+        self.wit_path: str = os.path.join(self.root, BASE_FOLDER_NAME)
+        self.references_data: dict[str, str | None] | None = None
+        self.activated_branch: str | None = None
+        # Commit ID -> the fields of its details file (parent, date and message).
+        self.commit_details: dict[str, dict[str, str]] = {}
+        self.commit_graph: dict[str, list] | None = None
+        # The commit IDs of the commit graph in sorted order, to resolve short IDs with a binary search.
+        self.sorted_commit_ids: list[str] | None = None
+        # Commit ID -> root tree ID, and tree ID -> its entries (trees never change, see `read_tree`).
+        self.commit_trees: dict[str, str] = {}
+        self.trees: dict[str, dict[str, tuple[str, str]]] = {}
+        # Root tree ID of the staged files, None if it is not known (saved in the index).
+        self.index_tree: str | None = None
+        self.packs: list[tuple[str, mmap.mmap]] | None = None
+        self.ignore_rules: IgnoreRules | None = None
+        # The paths of a sparse checkout ([] for the whole tree, None if not read yet), see `get_sparse_paths`.
+        self.sparse_paths: list[str] | None = None
+        self.sparse_prefixes: tuple[str, ...] = ()
+        # What the file system monitor reported at the last status, see `load_fsmonitor_state`.
+        self.fsmonitor_state: dict = {"index_timestamp": None, "token": None, "offset": 0, "untracked": [], "recheck": []}
+        self.migrate_images_folders()
+
+    @staticmethod
+    @traced
+    def find_root(path: str) -> str:
+        """Return the folder that contains the `.wit` folder, searching from path up."""
+        folder: str = os.path.abspath(path)
+        while not os.path.isdir(os.path.join(folder, BASE_FOLDER_NAME)):
+            trace_count("directories_searched")
+            if os.path.dirname(folder) == folder:
+                raise FileNotFoundError("not a wit repository (or any of the parent directories): .wit")
+            folder = os.path.dirname(folder)
+        return folder
+
+    def clear_cache(self) -> None:
+        """Forget everything that was read, for a repository that other processes changed."""
+        self.close_packs()
+        self.references_data = None
+        self.activated_branch = None
+        self.commit_details = {}
+        self.commit_graph = None
+        self.sorted_commit_ids = None
+        self.commit_trees = {}
+        self.ignore_rules = None
+        self.sparse_paths = None
+
+    def get_worktree_path(self, file: str) -> str:
+        """Return the path of a working tree file (given relative to the repository root)."""
+        return os.path.join(self.root, file)
+
+    def get_object_path(self, object_id: str) -> str:
+        """Return the path of an object in the objects folder."""
+        return os.path.join(self.wit_path, SUB_FOLDER_NAMES["objects"], object_id[:2], object_id[2:])
+
+    def get_chunk_list_path(self, object_id: str) -> str:
+        """Return the path of the chunk list of an object that is stored as chunks."""
+        return self.get_object_path(object_id) + CHUNK_LIST_SUFFIX
+
+    def write_object(self, object_id: str, content: bytes) -> None:
+        """Write an object (or a chunk list, with `CHUNK_LIST_SUFFIX`) to the objects folder."""
+        object_path: str = self.get_object_path(object_id)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        with open(f"{object_path}.wit-tmp", "wb") as file:
+            file.write(content)
+        os.replace(f"{object_path}.wit-tmp", object_path)
+
+    def store_object(self, file_path: str, object_id: str | None = None) -> str:
+        """Store the file content in the objects folder (only if not stored yet).
+
+        Large files are stored whole here, and split into chunks by `repack` (see `store_chunks`).
+
+        Args:
+            file_path (str): File to store.
+            object_id (str | None, optional): Known object ID of the file. Defaults to None.
+
+        Returns:
+            str: The object ID.
+        """
+        if object_id is None:
+            object_id = hash_file(file_path)
+        if self.has_object(object_id):
+            return object_id
+        copy_file(file_path, self.get_object_path(object_id))
+        return object_id
+
+    @traced
+    def store_chunks(self, file_path: str, object_id: str) -> tuple[int, int]:
+        """Store a large file as content-defined chunks (see `find_chunk_end`) and a chunk list.
+
+        Every chunk is an object, so only the chunks that changed since an earlier version are
+        written. The chunk list (`<object ID>.chunks` in the objects folder) has a
+        "<chunk ID> <size>" line for every chunk. The file is read once through a memory map.
+
+        Args:
+            file_path (str): File to store.
+            object_id (str): Object ID of the file (sha1 of the whole content).
+
+        Returns:
+            tuple[int, int]: Number of chunks and number of bytes of the chunks that were written.
+        """
+        chunk_lines: list[str] = []
+        chunks_written: int = 0
+        bytes_written: int = 0
+        with open(file_path, "rb") as file, map_file(file) as data:
+            start: int = 0
+            while start < len(data):
+                end: int = find_chunk_end(data, start, len(data))
+                chunk: bytes = data[start:end]
+                chunk_id: str = hashlib.sha1(chunk).hexdigest()
+                if not self.has_object(chunk_id):
+                    self.write_object(chunk_id, chunk)
+                    chunks_written += 1
+                    bytes_written += end - start
+                chunk_lines.append(f"{chunk_id} {end - start}\n")
+                start = end
+        trace_count("chunks_written", chunks_written)
+        trace_count("chunks_reused", len(chunk_lines) - chunks_written)
+        self.write_object(object_id + CHUNK_LIST_SUFFIX, "".join(chunk_lines).encode())
+        return chunks_written, bytes_written
+
+    def read_chunk_list(self, object_id: str) -> list[tuple[str, int]] | None:
+        """Return the (chunk ID, size) of every chunk of an object (None if it is not stored as chunks)."""
+        try:
+            with open(self.get_chunk_list_path(object_id), "r") as file:
+                return [(chunk_id, int(size)) for chunk_id, size in (line.split() for line in file)]
+        except FileNotFoundError:
+            return None
+
+    def restore_object(self, object_id: str, destination_path: str) -> None:
+        """Write the object content to destination path."""
+        if os.path.exists(self.get_object_path(object_id)):
+            copy_file(self.get_object_path(object_id), destination_path)
+            return
+        os.makedirs(os.path.dirname(destination_path) or ".", exist_ok=True)
+        if os.path.lexists(f"{destination_path}.wit-tmp"):
+            os.remove(f"{destination_path}.wit-tmp")
+        with open(f"{destination_path}.wit-tmp", "wb") as file:
+            for block in self.iter_object_chunks(object_id):
+                file.write(block)
+            trace_count("files_copied")
+            trace_count("bytes_copied", file.tell())
+        os.replace(f"{destination_path}.wit-tmp", destination_path)
+
+    def stage_object(self, object_id: str, stage_file_path: str, source_path: str | None = None) -> int:
+        """Place the object in the `staging_area`, as a hard link to the object when possible.
+
+        Args:
+            object_id (str): Object ID.
+            stage_file_path (str): File path in the `staging_area`.
+            source_path (str | None, optional): A file with the object content, copied when the object
+                can not be linked (e.g. it is stored as chunks). Defaults to None (the object is restored).
+
+        Returns:
+            int: Number of bytes written (0 for a hard link).
+        """
+        temp_path: str = f"{stage_file_path}.wit-tmp"
+        os.makedirs(os.path.dirname(stage_file_path), exist_ok=True)
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        try:
+            os.link(self.get_object_path(object_id), temp_path)
+            if tracer is not None:
+                trace_count("files_linked")
+        except OSError:
+            if source_path is not None:
+                copy_file(source_path, stage_file_path)
+            else:
+                self.restore_object(object_id, stage_file_path)
+            return os.path.getsize(stage_file_path)
+        os.replace(temp_path, stage_file_path)
+        return 0
+
+    def get_loose_object_ids(self, suffix: str = "") -> list[str]:
+        """Return the IDs of the objects that are stored as files in the objects folder.
+
+        Args:
+            suffix (str, optional): `CHUNK_LIST_SUFFIX` for the IDs of the objects stored as chunks. Defaults to "".
+        """
+        objects_folder: str = os.path.join(self.wit_path, SUB_FOLDER_NAMES["objects"])
+        object_ids: list[str] = []
+        for folder in os.listdir(objects_folder):
+            if len(folder) == 2:
+                object_ids.extend(folder + name.removesuffix(suffix)
+                                  for name in os.listdir(os.path.join(objects_folder, folder))
+                                  if len(name) == 38 + len(suffix) and name.endswith(suffix))
+        return object_ids
+
+    def load_packs(self) -> list[tuple[str, mmap.mmap]]:
+        """Return (pack path, mapped pack index) for every pack of the repository."""
+        if self.packs is None:
+            self.packs = []
+            pack_folder: str = os.path.join(self.wit_path, SUB_FOLDER_NAMES["objects"], PACK_FOLDER_NAME)
+            if os.path.isdir(pack_folder):
+                for name in sorted(os.listdir(pack_folder)):
+                    if name.endswith(".idx"):
+                        with open(os.path.join(pack_folder, name), "rb") as file:
+                            self.packs.append((os.path.join(pack_folder, name.removesuffix(".idx") + ".pack"),
+                                               mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)))
+        return self.packs
+
+    def close_packs(self) -> None:
+        """Close the mapped pack indexes (they are loaded again when needed)."""
+        for _, pack_index in self.packs or []:
+            pack_index.close()
+        self.packs = None
+
+    def find_packed_object(self, object_id: str) -> tuple[str, int] | None:
+        """Return the pack path and the offset of a packed object (None if it is not packed).
+
+        The pack index is a 256 entries fan-out table (number of objects whose first byte is
+        lower or equal) followed by sorted (object ID, offset) records, so a lookup is a binary
+        search in the records of one first byte.
+        """
+        key: bytes = bytes.fromhex(object_id)
+        for pack_path, pack_index in self.load_packs():
+            fanout_offset: int = len(PACK_INDEX_SIGNATURE)
+            low: int = struct.unpack_from(">I", pack_index, fanout_offset + 4 * (key[0] - 1))[0] if key[0] else 0
+            high: int = struct.unpack_from(">I", pack_index, fanout_offset + 4 * key[0])[0]
+            records_offset: int = fanout_offset + 256 * 4
+            while low < high:
+                middle: int = (low + high) // 2
+                record_key, offset = PACK_INDEX_RECORD.unpack_from(pack_index, records_offset + middle * PACK_INDEX_RECORD.size)
+                if record_key == key:
+                    return pack_path, offset
+                if record_key < key:
+                    low = middle + 1
+                else:
+                    high = middle
+        return None
+
+    def has_object(self, object_id: str) -> bool:
+        """Return True if the object is stored (as a file, as chunks or in a pack)."""
+        return (os.path.exists(self.get_object_path(object_id)) or os.path.exists(self.get_chunk_list_path(object_id))
+                or self.find_packed_object(object_id) is not None)
+
+    def iter_object_chunks(self, object_id: str) -> Iterator[bytes]:
+        """Yield the content of an object in blocks.
+
+        Full objects in packs are decompressed while reading, only deltas (which are
+        small, see `DELTA_MAX_SIZE`) are rebuilt in memory. Objects stored as chunks are
+        read chunk by chunk.
+        """
+        try:
+            with open(self.get_object_path(object_id), "rb") as file:
+                while block := file.read(BLOCK_SIZE):
+                    yield block
+            return
+        except FileNotFoundError:
+            pass
+        chunk_list: list[tuple[str, int]] | None = self.read_chunk_list(object_id)
+        if chunk_list is not None:
+            for chunk_id, _ in chunk_list:
+                yield from self.iter_object_chunks(chunk_id)
+            return
+        location: tuple[str, int] | None = self.find_packed_object(object_id)
+        if location is None:
+            raise FileNotFoundError(f"Object `{object_id}` not found.")
+        pack_path, offset = location
+        with open(pack_path, "rb") as pack:
+            pack.seek(offset)
+            entry_type, _, base_id, compressed_size = read_pack_entry_header(pack)
+            if entry_type == PACK_DELTA_ENTRY:
+                yield apply_delta(self.read_object(base_id), zlib.decompress(pack.read(compressed_size)))
+                return
+            decompressor = zlib.decompressobj()
+            while compressed_size > 0:
+                block = pack.read(min(BLOCK_SIZE, compressed_size))
+                compressed_size -= len(block)
+                yield decompressor.decompress(block)
+            yield decompressor.flush()
+
+    def read_object(self, object_id: str) -> bytes:
+        """Return the whole content of an object."""
+        return b"".join(self.iter_object_chunks(object_id))
+
+    def extract_object(self, object_id: str, folder: str) -> str:
+        """Return a file path with the object content (packed objects are written into folder)."""
+        object_path: str = self.get_object_path(object_id)
+        if os.path.exists(object_path):
+            return object_path
+        extracted_path: str = os.path.join(folder, object_id)
+        if not os.path.exists(extracted_path):
+            self.restore_object(object_id, extracted_path)
+        return extracted_path
+
+    @traced
+    def get_delta_bases(self) -> tuple[list[str], dict[str, str]]:
+        """Return the objects ordered by path and history, and the previous version of every object.
+
+        Returns:
+            tuple[list[str], dict[str, str]]: Ordered object IDs, object ID -> delta base object ID.
+        """
+        versions: dict[str, list[str]] = {}
+        seen: set[str] = set()
+        # The commit graph lists parents before their children.
+        for commit in self.load_commit_graph()["ids"]:
+            for file, object_id in self.read_manifest(commit).items():
+                if object_id not in seen:
+                    seen.add(object_id)
+                    versions.setdefault(file, []).append(object_id)
+        ordered_ids: list[str] = []
+        delta_bases: dict[str, str] = {}
+        for file in sorted(versions):
+            file_versions: list[str] = versions[file]
+            ordered_ids.extend(file_versions)
+            delta_bases.update(zip(file_versions[1:], file_versions))
+        return ordered_ids, delta_bases
+
+    def get_delta_depth(self, object_id: str) -> int | None:
+        """Return the length of the delta chain of a packed object (None if it is not packed)."""
+        depth: int = 0
+        while (location := self.find_packed_object(object_id)) is not None:
+            pack_path, offset = location
+            with open(pack_path, "rb") as pack:
+                pack.seek(offset)
+                entry_type, _, base_id, _ = read_pack_entry_header(pack)
+            if entry_type == PACK_FULL_ENTRY:
+                return depth
+            object_id = base_id
+            depth += 1
+        return None
+
+    def write_pack_entry(self, pack, object_id: str, base_id: str | None, depths: dict[str, int]) -> bool:
+        """Write one object to the pack, as a delta against base_id when it is small enough.
+
+        Returns:
+            bool: True if the object was stored as a delta.
+        """
+        if base_id is not None and base_id not in depths and (base_depth := self.get_delta_depth(base_id)) is not None:
+            depths[base_id] = base_depth
+        size: int = sum(len(block) for block in self.iter_object_chunks(object_id)) if base_id in depths else 0
+        if base_id in depths and depths[base_id] < DELTA_MAX_DEPTH and size <= DELTA_MAX_SIZE:
+            base: bytes = self.read_object(base_id)
+            if len(base) <= DELTA_MAX_SIZE:
+                target: bytes = self.read_object(object_id)
+                delta: bytes = create_delta(base, target)
+                if len(delta) < len(target) // 2 and apply_delta(base, delta) == target:
+                    compressed: bytes = zlib.compress(delta)
+                    pack.write(PACK_ENTRY_HEADER.pack(PACK_DELTA_ENTRY, len(target)) + bytes.fromhex(base_id))
+                    pack.write(struct.pack(">Q", len(compressed)) + compressed)
+                    depths[object_id] = depths[base_id] + 1
+                    return True
+        header_offset: int = pack.tell()
+        pack.write(PACK_ENTRY_HEADER.pack(PACK_FULL_ENTRY, 0) + struct.pack(">Q", 0))
+        compressor = zlib.compressobj()
+        size = compressed_size = 0
+        for block in self.iter_object_chunks(object_id):
+            size += len(block)
+            compressed_block: bytes = compressor.compress(block)
+            compressed_size += len(compressed_block)
+            pack.write(compressed_block)
+        compressed_block = compressor.flush()
+        compressed_size += len(compressed_block)
+        pack.write(compressed_block)
+        end_offset: int = pack.tell()
+        pack.seek(header_offset)
+        pack.write(PACK_ENTRY_HEADER.pack(PACK_FULL_ENTRY, size) + struct.pack(">Q", compressed_size))
+        pack.seek(end_offset)
+        depths[object_id] = 0
+        return False
+
+    @traced
+    def write_pack(self, object_ids: list[str], delta_bases: dict[str, str], pack_folder: str | None = None) -> tuple[str, int]:
+        """Write the objects into a new pack and its index.
+
+        Args:
+            object_ids (list[str]): Objects to pack (a delta base must come before the objects that use it).
+            delta_bases (dict[str, str]): Object ID -> object ID to store it as a delta against.
+            pack_folder (str | None, optional): Pack folder of another repository to send the objects to.
+                Defaults to None (the pack folder of this repository).
+
+        Returns:
+            tuple[str, int]: The pack path and the number of objects stored as deltas.
+        """
+        pack_folder = pack_folder or os.path.join(self.wit_path, SUB_FOLDER_NAMES["objects"], PACK_FOLDER_NAME)
+        os.makedirs(pack_folder, exist_ok=True)
+        pack_name: str = "pack-" + hashlib.sha1("".join(sorted(object_ids)).encode()).hexdigest()
+        pack_path: str = os.path.join(pack_folder, f"{pack_name}.pack")
+        offsets: dict[str, int] = {}
+        depths: dict[str, int] = {}
+        deltas: int = 0
+        with open(f"{pack_path}.tmp", "wb") as pack:
+            pack.write(PACK_SIGNATURE)
+            for object_id in object_ids:
+                offsets[object_id] = pack.tell()
+                deltas += self.write_pack_entry(pack, object_id, delta_bases.get(object_id), depths)
+        keys: list[bytes] = sorted(bytes.fromhex(object_id) for object_id in object_ids)
+        fanout: list[int] = [0] * 256
+        for key in keys:
+            fanout[key[0]] += 1
+        for first_byte in range(1, 256):
+            fanout[first_byte] += fanout[first_byte - 1]
+        index_path: str = os.path.join(pack_folder, f"{pack_name}.idx")
+        with open(f"{index_path}.tmp", "wb") as pack_index:
+            pack_index.write(PACK_INDEX_SIGNATURE + struct.pack(">256I", *fanout))
+            for key in keys:
+                pack_index.write(PACK_INDEX_RECORD.pack(key, offsets[key.hex()]))
+        os.replace(f"{pack_path}.tmp", pack_path)
+        os.replace(f"{index_path}.tmp", index_path)
+        return pack_path, deltas
+
+    @traced
+    def chunk_large_objects(self, keep: Container[str] | None = None) -> set[str]:
+        """Store the loose objects of at least `CHUNKED_FILE_MIN_SIZE` bytes as chunks (see `store_chunks`).
+
+        `add` and `commit` store large files whole (a copy at the speed of the disk), and they are
+        chunked here, so the versions of a large file share their unchanged chunks once repacked.
+
+        Args:
+            keep (Container[str] | None, optional): Chunk only these objects. Defaults to None (all the objects).
+
+        Returns:
+            set[str]: The chunk IDs of the chunked objects.
+        """
+        chunk_ids: set[str] = set()
+        chunks_written: int = 0
+        bytes_written: int = 0
+        chunked_objects: int = 0
+        for object_id in self.get_loose_object_ids():
+            object_path: str = self.get_object_path(object_id)
+            if keep is not None and object_id not in keep or os.path.getsize(object_path) < CHUNKED_FILE_MIN_SIZE:
+                continue
+            if not os.path.exists(self.get_chunk_list_path(object_id)):
+                object_chunks, object_bytes = self.store_chunks(object_path, object_id)
+                chunks_written += object_chunks
+                bytes_written += object_bytes
+            chunk_ids.update(chunk_id for chunk_id, _ in self.read_chunk_list(object_id))
+            os.remove(object_path)
+            chunked_objects += 1
+        if chunked_objects:
+            print(f"Chunked {chunked_objects} large object(s): {chunks_written} new chunk(s), {bytes_written} bytes written.")
+        return chunk_ids
+
+    @traced
+    def repack(self, all_objects: bool = False, keep: Container[str] | None = None) -> None:
+        """Move the loose objects into a compressed pack (objects are stored as deltas against their previous version).
+
+        Large loose objects are split into chunks first (see `chunk_large_objects`), and the chunks are packed.
+
+        Args:
+            all_objects (bool, optional): Also repack the objects of the existing packs into the new pack. Defaults to False.
+            keep (Container[str] | None, optional): Pack only these objects, the others are dropped from the repacked
+                packs (and stay loose). Defaults to None (all the objects).
+        """
+        chunk_ids: set[str] = self.chunk_large_objects(keep)
+        loose_ids: list[str] = self.get_loose_object_ids()
+        old_packs: list[str] = [pack_path for pack_path, _ in self.load_packs()] if all_objects else []
+        object_ids: set[str] = set(loose_ids)
+        for pack_path in old_packs:
+            with open(pack_path.removesuffix(".pack") + ".idx", "rb") as pack_index:
+                data: bytes = pack_index.read()
+            records_offset: int = len(PACK_INDEX_SIGNATURE) + 256 * 4
+            object_ids.update(data[offset:offset + 20].hex()
+                              for offset in range(records_offset, len(data), PACK_INDEX_RECORD.size))
+        if keep is not None:
+            object_ids = {object_id for object_id in object_ids if object_id in keep or object_id in chunk_ids}
+        if not object_ids:
+            print("Nothing to pack.")
+            return
+        ordered_ids, delta_bases = self.get_delta_bases()
+        ordered_ids = [object_id for object_id in ordered_ids if object_id in object_ids]
+        if keep is not None:
+            # A base outside the new pack may be in a pack that is removed.
+            delta_bases = {object_id: base_id for object_id, base_id in delta_bases.items() if base_id in object_ids}
+        ordered_ids.extend(sorted(object_ids.difference(ordered_ids)))
+        loose_ids = [object_id for object_id in loose_ids if object_id in object_ids]
+        size_before: int = sum(os.path.getsize(self.get_object_path(object_id)) for object_id in loose_ids)
+        size_before += sum(os.path.getsize(pack_path) for pack_path in old_packs)
+        pack_path, deltas = self.write_pack(ordered_ids, delta_bases)
+        self.close_packs()
+        for old_pack_path in old_packs:
+            if old_pack_path != pack_path:
+                os.remove(old_pack_path.removesuffix(".pack") + ".idx")
+                os.remove(old_pack_path)
+        for object_id in loose_ids:
+            os.remove(self.get_object_path(object_id))
+            if not os.listdir(os.path.dirname(self.get_object_path(object_id))):
+                os.rmdir(os.path.dirname(self.get_object_path(object_id)))
+        print(f"Packed {len(ordered_ids)} objects ({deltas} as deltas): {size_before} -> {os.path.getsize(pack_path)} bytes.")
+
+    @traced
+    def gc(self, grace_period: float = GC_GRACE_PERIOD) -> None:
+        """Remove the commits that no reference reaches, the objects that no kept commit uses and leftovers.
+
+        Commits reachable from the references are marked with the commit graph, and the objects of
+        the kept commits are marked with their trees (every tree once), so the time is linear in the
+        history size. The marked objects are kept in a bounded amount of memory (see `ObjectMarks`). Unreachable files are removed only when they are older than the grace period, so
+        commands that run at the same time (or commits that are not referenced yet) are not broken.
+        Leftovers are files of interrupted commands (`*.wit-tmp`, `*.wit-merge`, `*.tmp`, merge folders),
+        `staging_area` files that are not in the index and old `graphs` output.
+
+        Args:
+            grace_period (float, optional): Seconds to keep unreachable files. Defaults to `GC_GRACE_PERIOD` (two weeks).
+        """
+        self.check_for_commits()
+        expire_time: float = time.time() - grace_period
+        removed: dict[str, int] = {"commits": 0, "objects": 0, "leftovers": 0, "bytes": 0}
+
+        def remove(path: str, kind: str | None) -> None:
+            if os.path.isdir(path) and not os.path.islink(path):
+                removed["bytes"] += sum(os.lstat(os.path.join(folder, name)).st_size
+                                        for folder, _, names in os.walk(path) for name in names)
+                shutil.rmtree(path)
+            else:
+                removed["bytes"] += os.lstat(path).st_size
+                os.remove(path)
+            if kind is not None:
+                removed[kind] += 1
+
+        images_folder: str = os.path.join(self.wit_path, SUB_FOLDER_NAMES["images"])
+        with trace_span("mark_commits"):
+            # The graph is rebuilt from the details files, so every commit is in it.
+            self.build_commit_graph_file()
+            self.commit_graph = None
+            self.sorted_commit_ids = None
+            graph: dict[str, list] = self.load_commit_graph()
+            reachable: bytearray = bytearray(len(graph["ids"]))
+            roots: set[str | None] = set(self.get_references_data().values()) | {self.get_merge_head()}
+            stack: list[int] = [graph["positions"][commit] for commit in roots if commit not in (None, "None")]
+            for position in stack:
+                reachable[position] = 1
+            while stack:
+                for parent in graph["parents"][stack.pop()]:
+                    if not reachable[parent]:
+                        reachable[parent] = 1
+                        stack.append(parent)
+            kept_commits: set[str] = {commit for position, commit in enumerate(graph["ids"]) if reachable[position]
+                                      or os.path.getmtime(os.path.join(images_folder, f"{commit}.txt")) > expire_time}
+        with trace_span("sweep_commits"):
+            removed_commits: set[str] = set()
+            for name in os.listdir(images_folder):
+                path: str = os.path.join(images_folder, name)
+                commit: str = name.partition(".")[0]
+                if commit in kept_commits:
+                    continue
+                if commit in graph["positions"]:
+                    # The details file and the manifest of a commit are counted as one commit.
+                    remove(path, None)
+                    removed_commits.add(commit)
+                elif os.path.getmtime(path) <= expire_time:
+                    # Files of commits without a details file are removed when they are old.
+                    remove(path, "leftovers")
+            removed["commits"] = len(removed_commits)
+            if removed["commits"]:
+                self.build_commit_graph_file()
+                self.clear_cache()
+        # The marks are written to sorted files in this folder when there are many objects.
+        marks_folder: str = tempfile.mkdtemp(dir=self.wit_path)
+        live_objects: ObjectMarks = ObjectMarks(marks_folder)
+        try:
+            with trace_span("mark_objects"):
+                live_objects.update(entry[0] for entry in self.load_index().values())
+                for commit in kept_commits:
+                    stack_trees: list[str | None] = [self.get_commit_tree(commit)]
+                    while stack_trees:
+                        tree_id: str | None = stack_trees.pop()
+                        if tree_id is None or tree_id in live_objects:
+                            continue
+                        live_objects.add(tree_id)
+                        for kind, object_id in self.read_tree(tree_id, cache=False).values():
+                            if kind == "tree":
+                                stack_trees.append(object_id)
+                            else:
+                                live_objects.add(object_id)
+                # The chunks of the large files that are kept (the loose ones are chunked by `repack`).
+                chunked_objects: list[str] = self.get_loose_object_ids(CHUNK_LIST_SUFFIX)
+                for object_id in [object_id for object_id in chunked_objects if object_id in live_objects]:
+                    live_objects.update(chunk_id for chunk_id, _ in self.read_chunk_list(object_id))
+            with trace_span("sweep_objects"):
+                for object_id in chunked_objects:
+                    chunk_list_path: str = self.get_chunk_list_path(object_id)
+                    if object_id not in live_objects and os.path.getmtime(chunk_list_path) <= expire_time:
+                        remove(chunk_list_path, "objects")
+                for object_id in self.get_loose_object_ids():
+                    object_path: str = self.get_object_path(object_id)
+                    if object_id not in live_objects and os.path.getmtime(object_path) <= expire_time:
+                        remove(object_path, "objects")
+                        with contextlib.suppress(OSError):
+                            os.rmdir(os.path.dirname(object_path))
+                packed_objects: int = 0
+                for pack_path, pack_index in self.load_packs():
+                    records_offset: int = len(PACK_INDEX_SIGNATURE) + 256 * 4
+                    packed_objects += sum(pack_index[offset:offset + 20].hex() not in live_objects
+                                          for offset in range(records_offset, len(pack_index), PACK_INDEX_RECORD.size))
+                if packed_objects:
+                    size_before: int = sum(os.path.getsize(pack_path) for pack_path, _ in self.load_packs())
+                    self.repack(True, live_objects)
+                    removed["objects"] += packed_objects
+                    removed["bytes"] += size_before - sum(os.path.getsize(pack_path) for pack_path, _ in self.load_packs())
+        finally:
+            live_objects.close()
+            shutil.rmtree(marks_folder, ignore_errors=True)
+        with trace_span("sweep_leftovers"):
+            staging_area: str = os.path.join(self.wit_path, SUB_FOLDER_NAMES["staging_area"])
+            graphs_folder: str = os.path.join(self.wit_path, GRAPHS_FOLDER_NAME)
+            index: dict[str, list] = self.load_index()
+            for name in os.listdir(self.wit_path):
+                path = os.path.join(self.wit_path, name)
+                # Merge extracts objects to `tmp*` folders, files are replaced through `*.tmp` files.
+                if (name.startswith("tmp") and os.path.isdir(path) or name.endswith(".tmp")) \
+                        and os.path.getmtime(path) <= expire_time:
+                    remove(path, "leftovers")
+            for folder in (staging_area, graphs_folder, os.path.join(self.wit_path, SUB_FOLDER_NAMES["objects"])):
+                for dir, _, files in os.walk(folder):
+                    for name in files:
+                        path = os.path.join(dir, name)
+                        leftover: bool = folder == graphs_folder or name.endswith((".wit-tmp", ".wit-merge", ".tmp"))
+                        if folder == staging_area and not leftover:
+                            leftover = os.path.relpath(path, staging_area).replace(os.sep, "/") not in index
+                        if leftover and os.path.getmtime(path) <= expire_time:
+                            remove(path, "leftovers")
+        print(f"Removed {removed['commits']} unreachable commit(s), {removed['objects']} object(s) and "
+              f"{removed['leftovers']} leftover file(s): {removed['bytes']} bytes reclaimed.")
+
+    def get_manifest_path(self, commit: str) -> str:
+        """Return the path of the commit manifest file."""
+        return os.path.join(self.wit_path, SUB_FOLDER_NAMES["images"], f"{commit}.manifest")
+
+    @traced
+    def write_manifest(self, commit: str, manifest: dict[str, str]) -> str:
+        """Write the tree objects of the commit and its manifest file (`tree tree_id`, then `object_id path` per line).
+
+        Args:
+            commit (str): Commit ID.
+            manifest (dict[str, str]): Files of the commit and their object IDs.
+
+        Returns:
+            str: The root tree ID.
+        """
+        tree_id: str = self.write_trees(manifest)
+        with open(self.get_manifest_path(commit), "w", encoding="utf-8") as file:
+            file.write(f"tree {tree_id}\n")
+            for path in sorted(manifest):
+                file.write(f"{manifest[path]} {path}\n")
+        self.commit_trees[commit] = tree_id
+        return tree_id
+
+    @traced
+    def read_manifest(self, commit: str | None) -> dict[str, str]:
+        """Return the files of the commit and their object IDs."""
+        if commit is None or commit in ("", "None"):
+            return {}
+        manifest: dict[str, str] = {}
+        trace_count("metadata_files_opened")
+        try:
+            with open(self.get_manifest_path(commit), "r", encoding="utf-8") as file:
+                for line in file:
+                    object_id, path = line.rstrip("\n").split(" ", 1)
+                    if object_id != "tree":
+                        manifest[path] = object_id
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Commit `{commit}` not found.")
+        return manifest
+
+    def write_trees(self, files: dict[str, str]) -> str:
+        """Store the tree objects of the files that are not stored yet and return the root tree ID."""
+        trees: dict[str, tuple[str, bytes]] = build_trees(files)
+        for tree_id, content in trees.values():
+            if not self.has_object(tree_id):
+                self.write_object(tree_id, content)
+        return trees[""][0]
+
+    def get_commit_tree(self, commit: str | None) -> str | None:
+        """Return the root tree ID of the commit (None for no commit).
+
+        Only the first line of the manifest is read. Manifests of older versions,
+        without a tree, get their tree objects on the first call.
+
+        Raises:
+            FileNotFoundError: If the commit does not exist.
+        """
+        if commit is None or commit in ("", "None"):
+            return None
+        if commit not in self.commit_trees:
+            trace_count("metadata_files_opened")
+            try:
+                with open(self.get_manifest_path(commit), "r", encoding="utf-8") as file:
+                    first_line: str = file.readline()
+            except FileNotFoundError:
+                raise FileNotFoundError(f"Commit `{commit}` not found.")
+            if first_line.startswith("tree "):
+                self.commit_trees[commit] = first_line[5:].rstrip("\n")
+            else:
+                self.write_manifest(commit, self.read_manifest(commit))
+        return self.commit_trees[commit]
+
+    def read_tree(self, tree_id: str, cache: bool = True) -> dict[str, tuple[str, str]]:
+        """Return name -> (`blob` or `tree`, object ID) of the tree (every tree is read once, trees never change).
+
+        Args:
+            tree_id (str): Tree ID.
+            cache (bool, optional): Keep the tree for the next calls. Defaults to True.
+        """
+        if tree_id in self.trees:
+            return self.trees[tree_id]
+        trace_count("trees_read")
+        entries: dict[str, tuple[str, str]] = {}
+        for line in self.read_object(tree_id).decode().splitlines():
+            kind, object_id, name = line.split(" ", 2)
+            entries[name] = (kind, object_id)
+        if cache:
+            self.trees[tree_id] = entries
+        return entries
+
+    def get_tree_entry(self, tree_id: str | None, path: str) -> str | None:
+        """Return the object ID (or tree ID for a folder) at the path in the tree, reading one tree per folder of the path.
+
+        Args:
+            tree_id (str | None): Root tree ID.
+            path (str): Path relative to the repository ("/" separated, "." for the root).
+
+        Returns:
+            str | None: The ID, None if the path is not in the tree.
+        """
+        kind: str | None = "tree"
+        for name in path.split("/"):
+            if name in ("", "."):
+                continue
+            if kind != "tree" or tree_id is None:
+                return None
+            kind, tree_id = self.read_tree(tree_id).get(name, (None, None))
+        return tree_id
+
+    def diff_trees(self, old_tree: str | None, new_tree: str | None, prefix: str = "") -> dict[str, tuple[str | None, str | None]]:
+        """Return the files that differ between two trees, descending only into subtrees whose IDs differ.
+
+        Args:
+            old_tree (str | None): Old root tree ID (None for no files).
+            new_tree (str | None): New root tree ID (None for no files).
+            prefix (str, optional): Path of the trees (ends with "/"). Defaults to "".
+
+        Returns:
+            dict[str, tuple[str | None, str | None]]: File path -> (old object ID, new object ID), None where it does not exist.
+        """
+        changes: dict[str, tuple[str | None, str | None]] = {}
+        if old_tree == new_tree:
+            return changes
+        old_entries: dict[str, tuple[str, str]] = self.read_tree(old_tree) if old_tree is not None else {}
+        new_entries: dict[str, tuple[str, str]] = self.read_tree(new_tree) if new_tree is not None else {}
+        for name in old_entries.keys() | new_entries.keys():
+            old_kind, old_id = old_entries.get(name, (None, None))
+            new_kind, new_id = new_entries.get(name, (None, None))
+            if old_id == new_id:
+                continue
+            if "tree" in (old_kind, new_kind):
+                changes.update(self.diff_trees(old_id if old_kind == "tree" else None,
+                                               new_id if new_kind == "tree" else None, f"{prefix}{name}/"))
+            if "blob" in (old_kind, new_kind):
+                changes[f"{prefix}{name}"] = (old_id if old_kind == "blob" else None, new_id if new_kind == "blob" else None)
+        return changes
+
+    @traced
+    def migrate_images_folders(self) -> None:
+        """Convert old `images/<id>` folders into objects and manifests (runs once)."""
+        objects_folder: str = os.path.join(self.wit_path, SUB_FOLDER_NAMES["objects"])
+        if os.path.isdir(objects_folder):
+            return
+        images_folder: str = os.path.join(self.wit_path, SUB_FOLDER_NAMES["images"])
+        for name in os.listdir(images_folder):
+            image_path: str = os.path.join(images_folder, name)
+            if os.path.isdir(image_path):
+                manifest: dict[str, str] = {file: self.store_object(os.path.join(image_path, file))
+                                            for file in create_files_list(image_path)}
+                self.write_manifest(name, manifest)
+                shutil.rmtree(image_path)
+        os.makedirs(objects_folder, exist_ok=True)
+
+    @traced
+    def load_index(self) -> dict[str, list]:
+        """Return the index: staged file -> [staged object ID, working tree object ID, size, mtime_ns, inode].
+
+        The last four fields cache the hash of the working tree file for the stat
+        that was seen when it was hashed (None if unknown).
+        The root tree ID of the staged files is loaded to `index_tree` (it is kept while
+        the stage matches a commit, so status can compare the stage to it without reading the manifest).
+        If the index file does not exist yet it is built from the `staging_area` folder.
+        """
+        trace_count("metadata_files_opened")
+        try:
+            with open(os.path.join(self.wit_path, INDEX_FILE_NAME), "r", encoding="utf-8") as file:
+                index_data: dict = json.load(file)
+        except FileNotFoundError:
+            stage_path: str = os.path.join(self.wit_path, SUB_FOLDER_NAMES["staging_area"])
+            index: dict[str, list] = {file: [hash_file(os.path.join(stage_path, file)), None, None, None, None]
+                                      for file in create_files_list(stage_path)}
+            self.index_tree = None
+            self.save_index(index)
+            return index
+        index = index_data["entries"]
+        self.index_tree = index_data.get("tree")
+        self.load_fsmonitor_state(index_data["timestamp"])
+        racy_limit: int = index_data["timestamp"] - RACY_WINDOW_NS
+        for entry in index.values():
+            if entry[3] is not None and entry[3] >= racy_limit:
+                entry[1:] = [None, None, None, None]
+        return index
+
+    @traced
+    def save_index(self, index: dict[str, list]) -> None:
+        """Write the index file (and the file system monitor state that matches it)."""
+        index_path: str = os.path.join(self.wit_path, INDEX_FILE_NAME)
+        timestamp: int = time.time_ns()
+        with open(f"{index_path}.tmp", "w", encoding="utf-8") as file:
+            json.dump({"timestamp": timestamp, "tree": self.index_tree, "entries": index}, file, separators=(",", ":"))
+        os.replace(f"{index_path}.tmp", index_path)
+        self.fsmonitor_state["index_timestamp"] = timestamp
+        self.save_fsmonitor_state()
+
+    def get_fsmonitor_path(self, name: str = "") -> str:
+        """Return the path of a file in the file system monitor folder."""
+        return os.path.join(self.wit_path, FSMONITOR_FOLDER_NAME, name)
+
+    def load_fsmonitor_state(self, index_timestamp: int) -> None:
+        """Load the file system monitor state saved with the index.
+
+        The state is used only if it was saved with this version of the index,
+        otherwise the next status scans the whole working tree.
+
+        Args:
+            index_timestamp (int): Timestamp of the loaded index.
+        """
+        state: dict = {}
+        if os.path.isdir(self.get_fsmonitor_path()):
+            trace_count("metadata_files_opened")
+            try:
+                with open(self.get_fsmonitor_path(FSMONITOR_STATE_FILE_NAME), "r", encoding="utf-8") as file:
+                    state = json.load(file)
+            except (FileNotFoundError, ValueError):
+                pass
+        if state.get("index_timestamp") != index_timestamp:
+            state = {}
+        self.fsmonitor_state.clear()
+        self.fsmonitor_state.update({"index_timestamp": index_timestamp, "token": None, "offset": 0,
+                                     "untracked": [], "recheck": []}, **state)
+
+    def save_fsmonitor_state(self) -> None:
+        """Write the file system monitor state (if a watcher was ever queried)."""
+        if self.fsmonitor_state["token"] is None:
+            return
+        state_path: str = self.get_fsmonitor_path(FSMONITOR_STATE_FILE_NAME)
+        with open(f"{state_path}.tmp", "w", encoding="utf-8") as file:
+            json.dump(self.fsmonitor_state, file, separators=(",", ":"))
+        os.replace(f"{state_path}.tmp", state_path)
+
+    @traced
+    def query_fsmonitor(self) -> tuple[dict | None, set[str] | None]:
+        """Ask the running `wit watch` which paths changed since the last status.
+
+        A cookie file is created and the journal is read up to the line the watcher
+        wrote for the cookie, so every change made before the query is included.
+
+        Returns:
+            tuple[dict | None, set[str] | None]: The new token and journal offset (None if no watcher
+                is running), and the changed paths (folders end with "/"). The paths are None if the
+                whole tree must be scanned: the watcher restarted, lost events or did not answer.
+        """
+        try:
+            with open(self.get_fsmonitor_path(FSMONITOR_WATCHER_FILE_NAME), "r") as file:
+                pid, token = file.read().split()
+            if os.name == "posix":
+                os.kill(int(pid), 0)
+        except (OSError, ValueError):
+            return None, None
+        journal_path: str = self.get_fsmonitor_path(FSMONITOR_JOURNAL_NAME)
+        cookie: str = f"{os.getpid()}-{time.time_ns()}"
+        cookie_path: str = os.path.join(self.get_fsmonitor_path(FSMONITOR_COOKIES_FOLDER_NAME), cookie)
+        cookie_line: bytes = f"!cookie {cookie}\n".encode()
+        known_token: bool = self.fsmonitor_state["token"] == token
+        lines: list[bytes] = []
         try:
-            parent_file_line: str = next(parent_file)
-        except StopIteration:
-            parent_file_line = ""
+            # The cookie line is written after the current end of the journal.
+            start: int = self.fsmonitor_state["offset"] if known_token else os.path.getsize(journal_path)
+            open(cookie_path, "w").close()
+            deadline: float = time.monotonic() + FSMONITOR_TIMEOUT
+            with open(journal_path, "rb") as journal:
+                if journal.readline() != f"{token}\n".encode():
+                    return None, None
+                journal.seek(max(start, journal.tell()))
+                while True:
+                    line: bytes = journal.readline()
+                    if line == cookie_line:
+                        break
+                    if line.endswith(b"\n"):
+                        if known_token:
+                            lines.append(line)
+                        continue
+                    if time.monotonic() > deadline:
+                        return None, None
+                    journal.seek(-len(line), os.SEEK_CUR)
+                    time.sleep(0.005)
+                offset: int = journal.tell()
+        except FileNotFoundError:
+            return None, None
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(cookie_path)
+        state: dict = {"token": token, "offset": offset}
+        if not known_token or b"!overflow\n" in lines:
+            return state, None
+        changed: set[str] = {os.fsdecode(line[:-1]) for line in lines if not line.startswith(b"!")}
+        trace_count("fsmonitor_changed_paths", len(changed))
+        return state, changed
+
+    @traced
+    def get_worktree_files(self, index: dict[str, list], folder: str = ".") -> tuple[list[str], set[str] | None, dict | None]:
+        """Return the working tree files to check, using the file system monitor when it is running.
+
+        Args:
+            index (dict[str, list]): The index.
+            folder (str, optional): Only files under this folder (relative to the repository). Defaults to ".".
+
+        Returns:
+            tuple[list[str], set[str] | None, dict | None]: The files (tracked and untracked, some may
+                not exist anymore), the files that did not change since the last status (None if the
+                tree was walked), and the new monitor state for `get_status` to save.
+        """
+        monitor_state, changed = self.query_fsmonitor()
+        if changed is not None and any(os.path.basename(path) == IGNORE_FILE_NAME for path in changed):
+            # The ignore rules changed, so files that were ignored may be untracked now.
+            changed = None
+        if changed is None:
+            # The walk reads every ignore file again.
+            self.ignore_rules = IgnoreRules(self.root)
+            roots: list[str] = [folder]
+            if not self.is_sparse(folder):
+                # Only the sparse paths under the folder are walked.
+                roots = [path for path in self.get_sparse_paths() if folder == "." or path.startswith(f"{folder}/")]
+            files: set[str] = set()
+            for root in roots:
+                if os.path.isdir(self.get_worktree_path(root)):
+                    files.update(walk_worktree(self.root, root, self.ignore_rules))
+                elif os.path.lexists(self.get_worktree_path(root)) and not self.ignore_rules.is_ignored(root):
+                    files.add(root)
+            # Tracked files stay tracked in ignored folders, and missing ones lose their cached hash.
+            files.update(file for file in index if (folder == "." or file.startswith(f"{folder}/") or file == folder)
+                         and self.is_sparse(file))
+            return sorted(files), None, monitor_state
+        ignore_rules: IgnoreRules = self.get_ignore_rules()
+        changed.update(self.fsmonitor_state["recheck"])
+        changed_folders: tuple[str, ...] = tuple(path for path in changed if path.endswith("/"))
+        changed_files: set[str] = {path for path in changed
+                                   if not path.endswith("/") and (path in index or not ignore_rules.is_ignored(path))}
+        for changed_folder in changed_folders:
+            # Folders that were created or moved are walked, the watcher reports only the folder.
+            if os.path.isdir(self.get_worktree_path(changed_folder)):
+                changed_files.update(walk_worktree(self.root, changed_folder.rstrip("/"), ignore_rules))
+        all_files: set[str] = set(index).union(self.fsmonitor_state["untracked"], changed_files)
+        if self.get_sparse_paths():
+            all_files = {file for file in all_files if self.is_sparse(file)}
+        if changed_folders:
+            changed_files.update(file for file in all_files if file.startswith(changed_folders))
+        if folder != ".":
+            all_files = {file for file in all_files if file.startswith(f"{folder}/") or file == folder}
+        return sorted(all_files), all_files - changed_files, monitor_state
+
+    def get_sparse_paths(self) -> list[str]:
+        """Return the paths of the sparse checkout ([] if the whole working tree is checked out), the file is read once."""
+        if self.sparse_paths is None:
+            self.sparse_paths = []
+            trace_count("metadata_files_opened")
+            try:
+                with open(os.path.join(self.wit_path, SPARSE_FILE_NAME), "r", encoding="utf-8") as file:
+                    self.sparse_paths = [line.strip().strip("/") for line in file
+                                         if line.strip() and not line.startswith("#")]
+            except FileNotFoundError:
+                pass
+            if "" in self.sparse_paths or "." in self.sparse_paths:
+                self.sparse_paths = []
+            self.sparse_prefixes = tuple(f"{path}/" for path in self.sparse_paths)
+        return self.sparse_paths
+
+    def is_sparse(self, path: str) -> bool:
+        """Return True if the path (relative to the root) is checked out: it is a sparse path, under one, or
+        the ignore file of a folder above one (always True without sparse paths)."""
+        sparse_paths: list[str] = self.get_sparse_paths()
+        if not sparse_paths or path in sparse_paths or path.startswith(self.sparse_prefixes):
+            return True
+        # The ignore files of the parent folders apply to the sparse paths too.
+        folder, _, name = path.rpartition("/")
+        return name == IGNORE_FILE_NAME and (not folder or any(prefix.startswith(f"{folder}/") for prefix in self.sparse_prefixes))
+
+    @traced
+    def set_sparse_paths(self, paths: list[str]) -> None:
+        """Check out only the paths (and the files under them), or the whole tree if no paths are given.
+
+        Tracked files outside the paths are removed from the working tree but stay in the stage,
+        so they are kept in the next commits. The ignore files of the folders above the paths stay
+        checked out, so their rules still apply. Tracked files inside the paths that are missing are restored.
+        `status`, `add`, `commit`, `checkout` and `merge` then walk and write only the paths.
+
+        Args:
+            paths (list[str]): Folders or files, relative to the current folder.
+
+        Raises:
+            ValueError: If a path is not in the repository.
+        """
+        check_for_changes(self.get_status())
+        sparse_paths: list[str] = []
+        for path in paths:
+            relative_path: str = os.path.relpath(os.path.abspath(path), self.root).replace(os.sep, "/")
+            if relative_path == ".." or relative_path.startswith("../"):
+                raise ValueError(f"`{path}` is outside the repository `{self.root}`.")
+            sparse_paths.append(relative_path)
+        sparse_file_path: str = os.path.join(self.wit_path, SPARSE_FILE_NAME)
+        if sparse_paths:
+            with open(sparse_file_path, "w", encoding="utf-8") as file:
+                file.writelines(f"{path}\n" for path in sparse_paths)
+        elif os.path.exists(sparse_file_path):
+            os.remove(sparse_file_path)
+        self.sparse_paths = None
+        index: dict[str, list] = self.load_index()
+        checked_out: int = 0
+        for file, entry in index.items():
+            file_path: str = self.get_worktree_path(file)
+            if self.is_sparse(file):
+                checked_out += 1
+                if get_worktree_hash(entry, file_path) is None:
+                    self.restore_object(entry[0], file_path)
+                    update_index_entry(index, file, entry[0], file_path)
+            elif os.path.lexists(file_path):
+                remove_file(file_path, self.root)
+                entry[1:] = [None, None, None, None]
+        self.save_index(index)
+        print(f"{checked_out} of {len(index)} tracked file(s) are checked out.")
+
+    def get_ignore_rules(self) -> IgnoreRules:
+        """Return the `.witignore` rules of the working tree (every ignore file is read once)."""
+        if self.ignore_rules is None:
+            self.ignore_rules = IgnoreRules(self.root)
+        return self.ignore_rules
+
+    def watch(self, poll: bool = False) -> None:
+        """Watch the working tree and journal the changed paths until interrupted (Ctrl+C).
+
+        While it runs, status, commit, checkout and add check only the paths that changed
+        instead of walking the whole tree.
+
+        Args:
+            poll (bool, optional): Compare stats of the tree instead of using inotify. Defaults to False.
+        """
+        cookies_path: str = self.get_fsmonitor_path(FSMONITOR_COOKIES_FOLDER_NAME)
+        shutil.rmtree(cookies_path, ignore_errors=True)
+        os.makedirs(cookies_path)
+        journal: FsmonitorJournal = FsmonitorJournal(self.get_fsmonitor_path())
         try:
-            current_file_line: str = next(current_file)
-        except StopIteration:
-            current_file_line = ""
-        if merge_file_line == current_file_line:
-            fixed_file += merge_file_line
-        elif merge_file_line == parent_file_line:
-            fixed_file += current_file_line
-        elif current_file_line == parent_file_line:
-            fixed_file += merge_file_line
+            if not poll and sys.platform.startswith("linux"):
+                try:
+                    print(f"Watching {self.root} with inotify (press Ctrl+C to stop).")
+                    watch_inotify(journal, self.root)
+                except OSError as error:
+                    print(f"inotify failed ({error}), polling instead.")
+                    # Changes may have been lost, so readers of the journal must scan the tree.
+                    journal.start()
+            print(f"Watching {self.root} every {FSMONITOR_POLL_INTERVAL} seconds (press Ctrl+C to stop).")
+            watch_polling(journal, self.root)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            journal.close()
+
+    def update_activated_branch_file(self, branch: str) -> None:
+        """Update activated branch file."""
+        with open(os.path.join(self.wit_path, "activated.txt"), "w") as f:
+            f.write(branch)
+        self.activated_branch = branch
+
+    @classmethod
+    @traced
+    def init(cls, path: str = ".") -> "Repository":
+        """Initializing wit in the folder.
+
+        Args:
+            path (str, optional): The folder. Defaults to ".".
+
+        Returns:
+            Repository: The new repository.
+        """
+        root: str = os.path.abspath(path)
+        os.mkdir(os.path.join(root, BASE_FOLDER_NAME))
+        for folder in SUB_FOLDER_NAMES.values():
+            os.mkdir(os.path.join(root, BASE_FOLDER_NAME, folder))
+        repository: Repository = cls(root)
+        repository.update_activated_branch_file("master")
+        print(f"Initialized empty wit repository in {root}")
+        return repository
+
+    def get_new_folder_name(self) -> str:
+        """Return new folder image name."""
+        characters: str = "1234567890abcdef"
+        folder_name_len: int = 40
+        while True:
+            folder_name: str = "".join(random.choices(characters, k=folder_name_len))
+            if not os.path.exists(self.get_manifest_path(folder_name)):
+                return folder_name
+
+    @traced
+    def add(self, path: str) -> None:
+        """Adding the tree folders of the path to the `staging_area`.
+
+        Only files that are new or changed since they were staged are written.
+
+        Args:
+            path (str): File or folder to add (relative to the current folder).
+
+        Raises:
+            ValueError: If the path is the `.wit` folder, is not in the repository, is a file outside
+                the sparse checkout paths or is an untracked file that `.witignore` ignores.
+        """
+        source_path: str = os.path.abspath(path)
+        if os.path.basename(source_path) == BASE_FOLDER_NAME:
+            raise ValueError(f"Do not back up the `{BASE_FOLDER_NAME}` folder itself.")
+        relative_path: str = os.path.relpath(source_path, self.root).replace(os.sep, "/")
+        if relative_path == ".." or relative_path.startswith("../"):
+            raise ValueError(f"`{path}` is outside the repository `{self.root}`.")
+        stage_path: str = os.path.join(self.wit_path, SUB_FOLDER_NAMES["staging_area"])
+        index: dict[str, list] = self.load_index()
+        unchanged: set[str] | None = None
+        if os.path.isdir(source_path):
+            files, unchanged, _ = self.get_worktree_files(index, relative_path)
         else:
-            update_stage_area(os.path.join(BASE_FOLDER_NAME, SUB_FOLDER_NAMES["images"], last_commit))
-            raise ValueError(f"Conflict between file -> `{os.path.basename(current_file_path)}`")
-    for line in current_file:
-        fixed_file += line
-    with open(current_file_path, "w") as file:
-        file.write(fixed_file)
-
+            if not self.is_sparse(relative_path):
+                raise ValueError(f"`{path}` is outside the sparse checkout paths.")
+            if relative_path not in index and self.get_ignore_rules().is_ignored(relative_path):
+                raise ValueError(f"`{path}` is ignored by a `{IGNORE_FILE_NAME}` file.")
+            files = [relative_path]
+        files_written: int = 0
+        bytes_written: int = 0
+        entries: list[list] = [index.get(file, [None, None, None, None, None]) for file in files]
+        object_ids: list[str | None] = get_worktree_hashes(entries, [self.get_worktree_path(file) for file in files],
+                                                           [unchanged is not None and file in unchanged for file in files])
+        for file, entry, object_id in zip(files, entries, object_ids):
+            if object_id is None:
+                continue
+            index[file] = entry
+            if object_id == entry[0]:
+                continue
+            if not self.has_object(object_id):
+                self.store_object(self.get_worktree_path(file), object_id)
+                bytes_written += entry[2]
+            bytes_written += self.stage_object(object_id, os.path.join(stage_path, file), self.get_worktree_path(file))
+            entry[0] = object_id
+            files_written += 1
+        if files_written:
+            self.index_tree = None
+        self.save_index(index)
+        print(f"Added {files_written} changed file(s) to the staging area ({bytes_written} bytes written).")
+
+    def get_activated_branch(self) -> str:
+        """Return the activated branch (the file is read once)."""
+        if self.activated_branch is None:
+            trace_count("metadata_files_opened")
+            try:
+                with open(os.path.join(self.wit_path, "activated.txt"), "r") as f:
+                    self.activated_branch = f.read().strip()
+            except FileNotFoundError:
+                self.activated_branch = ""
+        return self.activated_branch
+
+    def get_references_data(self) -> dict[str, str | None]:
+        """Return a copy of the data from references file (the file is read once)."""
+        if self.references_data is None:
+            self.references_data = {"HEAD": None, 
+                                    "master": None}
+            trace_count("metadata_files_opened")
+            try:
+                with open(os.path.join(self.wit_path, "references.txt"), "r") as file:
+                    file_data: list[str] = file.read().strip().split("\n")
+                    for line in file_data:
+                        line: list[str, str] = line.split("=")
+                        # Written for references without a commit, read as None like the cached value.
+                        self.references_data[line[0]] = None if line[1] == "None" else line[1]
+            except FileNotFoundError:
+                pass
+        return dict(self.references_data)
+
+    def update_references_file(self, references_data: dict[str, str]) -> None:
+        """Update references file.
+
+        Args:
+            references_data (dict): All data: HEAD, master and branches.
+        """
+        with open(os.path.join(self.wit_path, "references.txt"), "w") as file:
+            for key, value in references_data.items():
+                file.write(f"{key}={value}\n")
+        self.references_data = dict(references_data)
+
+    def check_for_commits(self) -> None:
+        """Raise error if no commits have been made yet."""
+        references_data: dict[str, str | None] = self.get_references_data()
+        parent: str = references_data["HEAD"]
+        if parent is None:
+            raise FileNotFoundError("No commits have been made yet.")
+
+    @traced
+    def get_status(self, commit: str = None, path: str = ".") -> dict[str, list[str] | str | None]:
+        """Return the current state of your wit working directory and staging area.
+
+        Files whose stat did not change since they were last hashed are not read, and
+        while `wit watch` runs only the files that changed since the last status are checked.
+        Only the sparse checkout paths of the working tree are checked.
+
+        Args:
+            commit (str, optional): Commit ID to compare the stage with. Defaults to HEAD.
+            path (str, optional): Only files under this path (relative to the repository). Defaults to ".".
+
+        Returns:
+            dict[str, list[str] | str | None]: Status.
+        """
+        references_data: dict[str, str | None] = self.get_references_data()
+        parent: str = references_data["HEAD"]
+        source_path: str = self.root
+        all_status: dict[str, list[str] | str | None] = {
+                      "Current commit:": parent, 
+                      "Changes to be committed:": [], 
+                      "Changes not staged for commit:": [], 
+                      "Untracked files:": [], 
+                      }
+        index: dict[str, list] = self.load_index()
+        commit_tree: str | None = self.get_commit_tree(commit or parent)
+        files, unchanged, monitor_state = self.get_worktree_files(index, path)
+        with trace_span("compare_worktree"):
+            tracked_files: list[str] = []
+            for file in files:
+                file_path: str = os.path.join(source_path, file)
+                if file in index:
+                    tracked_files.append(file)
+                # Untracked files that the monitor reported were created may already be removed.
+                elif unchanged is None or file in unchanged or os.path.lexists(file_path) and not os.path.isdir(file_path):
+                    all_status["Untracked files:"].append(file)
+            cached: list[list] = [index[file][1:] for file in tracked_files]
+            worktree_hashes: list[str | None] = get_worktree_hashes(
+                [index[file] for file in tracked_files], [os.path.join(source_path, file) for file in tracked_files],
+                [unchanged is not None and file in unchanged for file in tracked_files])
+            index_changed: bool = any(index[file][1:] != entry_cache for file, entry_cache in zip(tracked_files, cached))
+            for file, worktree_hash in zip(tracked_files, worktree_hashes):
+                if worktree_hash is not None and worktree_hash != index[file][0]:
+                    all_status["Changes not staged for commit:"].append(file)
+        trace_count("files_compared", len(files) - len(all_status["Untracked files:"]))
+        with trace_span("compare_stage"):
+            # A stage with the tree of the commit has no changes, so the manifest is not read.
+            if self.index_tree is None or self.index_tree != commit_tree:
+                commit_files: dict[str, str] = self.read_manifest(commit or parent)
+                for file, entry in index.items():
+                    if commit_files.get(file) != entry[0] and (path == "." or file == path or file.startswith(f"{path}/")):
+                        all_status["Changes to be committed:"].append(file)
+        # The changes that the monitor reported outside the path are checked by the next full status.
+        if monitor_state is not None and path == ".":
+            self.fsmonitor_state.update(monitor_state, untracked=all_status["Untracked files:"], recheck=[])
+        if index_changed:
+            self.save_index(index)
+        else:
+            self.save_fsmonitor_state()
+        return all_status
+
+    def create_commit_file_data(self, folder_path: str, parent: str, message: str, second_parent: str | None = None) -> None:
+        """Write commit data file.
+
+        Args:
+            folder_path (str): Commit name with path.
+            parent (str): Parent of commit.
+            message (str): Commit description.
+            second_parent (str, optional): Second parent. Defaults to None.
+
+        Returns:
+            None.
+        """
+        if second_parent is not None:
+            parent += f", {second_parent}"
+        with open(f"{folder_path}.txt", "w") as file:
+            file.write(f"""parent={parent}\ndate={datetime.now():%a %b %d %H:%M:%S %Y} {time.strftime("%z")}\nmessage={message}""")
+
+    @traced
+    def commit(self, message: str, second_parent: str | None = None) -> None:
+        """Commit the changes to images folder.
+
+        Args:
+            message (str): Commit description.
+            second_parent (str | None, optional): Second parent. Defaults to None (the commit of a merge
+                that stopped on conflicts, see `merge`).
+
+        Raises:
+            FileExistsError: If nothing added to commit or commit already exist.
+        """
+        source_path: str = os.path.join(self.wit_path, SUB_FOLDER_NAMES["staging_area"])
+        destination_path: str = os.path.join(self.wit_path, SUB_FOLDER_NAMES["images"])
+        references_data: dict[str, str | None] = self.get_references_data()
+        parent: str = references_data["HEAD"]
+        merge_head: str | None = self.get_merge_head()
+        second_parent = second_parent or merge_head
+        status: dict[str, list[str] | str | None] = self.get_status()
+        if status["Current commit:"] is None and status["Changes to be committed:"] == []:
+            raise FileExistsError("Nothing added to commit (use `wit add` to track).")
+        # A merge commit may keep the tree of HEAD (e.g. the current versions of conflicting files were kept).
+        if status["Changes to be committed:"] == [] and second_parent is None:
+            raise FileExistsError("Image already exist.")
+        folder_name: str = self.get_new_folder_name()
+        folder_path: str = os.path.join(destination_path, folder_name)
+        # Only contents that are not in the objects folder yet are written.
+        index: dict[str, list] = self.load_index()
+        manifest: dict[str, str] = {file: self.store_object(os.path.join(source_path, file), entry[0])
+                                    for file, entry in index.items()}
+        self.index_tree = self.write_manifest(folder_name, manifest)
+        self.save_index(index)
+        self.create_commit_file_data(folder_path, parent, message, second_parent)
+        self.add_to_commit_graph(folder_name, [parent, second_parent])
+        references_data["HEAD"] = folder_name
+        current_branch: str = self.get_activated_branch()
+        if references_data.get(current_branch, "") == parent:
+            references_data[current_branch] = folder_name
+        self.update_references_file(references_data)
+        if merge_head is not None:
+            self.set_merge_head(None)
+        print(f"New commit created: {get_short_commit_name(folder_name)}")
+
+    def print_status(self, path: str | None = None) -> None:
+        """Prints the current state of your wit working directory and staging area.
+
+        Args:
+            path (str | None, optional): Only files under this path (relative to the current folder). Defaults to None (all files).
+        """
+        relative_path: str = "."
+        if path is not None:
+            relative_path = os.path.relpath(os.path.abspath(path), self.root).replace(os.sep, "/")
+            if relative_path == ".." or relative_path.startswith("../"):
+                raise ValueError(f"`{path}` is outside the repository `{self.root}`.")
+        status_data: dict[str, list[str] | str | None] = self.get_status(path=relative_path)
+        for state, data in status_data.items():
+            print(state)
+            if isinstance(data, list) and data != []:
+                for file in data:
+                    print(f"\t{os.path.relpath(self.get_worktree_path(file))}")
+            else:
+                print(f"\t{data or None}")
+            print()
+
+    @traced
+    def sync_stage_area(self, index: dict[str, list], changes: dict[str, str | None]) -> list[str]:
+        """Stage the changed files, touching only files whose staged object differs.
+
+        Args:
+            index (dict[str, list]): The index (updated in place).
+            changes (dict[str, str | None]): Files and object IDs to stage (None to remove the file).
+
+        Returns:
+            list[str]: Files that were removed from the stage.
+        """
+        staging_area: str = os.path.join(self.wit_path, SUB_FOLDER_NAMES["staging_area"])
+        removed_files: list[str] = [file for file, object_id in changes.items() if object_id is None and file in index]
+        for file in removed_files:
+            remove_file(os.path.join(staging_area, file), staging_area)
+            del index[file]
+        # A working tree file that is not staged anymore may be untracked now.
+        self.fsmonitor_state["recheck"].extend(removed_files)
+        for file, object_id in changes.items():
+            if object_id is None:
+                continue
+            # The working tree is not changed here, so its cached hashes are still valid.
+            entry: list = index.setdefault(file, [None, None, None, None, None])
+            if entry[0] != object_id:
+                self.stage_object(object_id, os.path.join(staging_area, file))
+                entry[0] = object_id
+        return removed_files
+
+    @traced
+    def checkout(self, id: str, ignore: bool = False) -> None:
+        """Updates files in the working tree to match the version in the id.
+
+        Only files that differ between the current stage and the id are removed or written,
+        in both the working tree and the `staging_area`. The stage matches HEAD (there are no
+        changes), so they are found by comparing the trees of HEAD and the id. A repository without
+        commits can check out the commits it fetched (`remote/branch`).
+
+        Args:
+            id (str): The id or name of commit.
+            ignore (bool, optional): Whether to check if there are changes or not (used in merge commends). Defaults to False.
+        """
+        references_data: dict[str, str | None] = self.get_references_data()
+        # Remote references (`remote/branch`) are checked out as a detached HEAD.
+        branch_name: str = id.lower() if id.lower() in references_data and "/" not in id else ""
+        id = self.resolve_commit(id)
+        tree_id: str | None = self.get_commit_tree(id)
+        destination_path: str = self.root
+        status_data: dict[str, list[str] | str | None] = self.get_status()
+        if not ignore:
+            check_for_changes(status_data)
+        # A merge that stopped on conflicts is abandoned.
+        self.set_merge_head(None)
+        self.update_activated_branch_file(branch_name)
+        index: dict[str, list] = self.load_index()
+        if ignore:
+            changes: dict[str, str | None] = get_stage_changes(index, self.read_manifest(id))
+        else:
+            head_tree: str | None = self.get_commit_tree(status_data["Current commit:"])
+            changes = {file: object_id for file, (_, object_id) in self.diff_trees(head_tree, tree_id).items()}
+            # Tracked files that were deleted from the working tree (their cached hash was cleared by the status) are restored.
+            changes.update((file, entry[0]) for file, entry in index.items()
+                           if entry[1] is None and file not in changes and self.is_sparse(file))
+        for file in self.sync_stage_area(index, changes):
+            remove_file(os.path.join(destination_path, file), destination_path)
+        # The files outside the sparse checkout paths are only staged.
+        for file, object_id in changes.items():
+            if object_id is None or not self.is_sparse(file):
+                continue
+            # Files that already have the right content keep their modification time
+            # (the cached hashes were just checked by the status).
+            file_path: str = self.get_worktree_path(file)
+            if get_worktree_hash(index[file], file_path, True) != object_id:
+                self.restore_object(object_id, file_path)
+                update_index_entry(index, file, object_id, file_path)
+        self.index_tree = tree_id
+        self.save_index(index)
+        references_data["HEAD"] = id
+        self.update_references_file(references_data)
+
+    def get_commit_details(self, commit: str) -> dict[str, str]:
+        """Return the fields of the commit details file: parent, date and message (the file is read once).
+
+        Raises:
+            FileNotFoundError: If the commit details file does not exist.
+        """
+        if commit not in self.commit_details:
+            trace_count("metadata_files_opened")
+            try:
+                with open(os.path.join(self.wit_path, SUB_FOLDER_NAMES["images"], f"{commit}.txt"), "r") as file:
+                    file_data: str = file.read()
+            except FileNotFoundError:
+                raise FileNotFoundError("Commit data not found.")
+            # The message is the rest of the file (it may have more lines).
+            parent, date, message = (file_data.split("\n", 2) + ["", ""])[:3]
+            self.commit_details[commit] = {"parent": parent.removeprefix("parent="),
+                                           "date": date.removeprefix("date="),
+                                           "message": message.removeprefix("message=")}
+        return self.commit_details[commit]
+
+    def get_parent(self, commit: str) -> list[str]:
+        """Return commit parent\s."""
+        return self.get_commit_details(commit)["parent"].split(", ")
+
+    def get_commit_timestamp(self, commit: str) -> int:
+        """Return the commit date as a unix timestamp (0 if it can not be read)."""
+        try:
+            date: str = self.get_commit_details(commit)["date"]
+            return int(datetime.strptime(date, "%a %b %d %H:%M:%S %Y %z").timestamp())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    @traced
+    def build_commit_graph_file(self) -> None:
+        """Write the commit graph file from the commits details files.
+
+        Every line is `commit first_parent second_parent generation timestamp`, where the parents
+        are line numbers of earlier lines (`-` for no parent). Parents are always written before
+        their children, so new commits are appended to the end of the file.
+        """
+        images_folder: str = os.path.join(self.wit_path, SUB_FOLDER_NAMES["images"])
+        parents: dict[str, list[str]] = {file.removesuffix(".txt"): [parent for parent in self.get_parent(file.removesuffix(".txt")) if parent != "None"]
+                                         for file in os.listdir(images_folder) if file.endswith(".txt")}
+        positions: dict[str, int] = {}
+        generations: list[int] = []
+        lines: list[str] = []
+        for root in parents:
+            stack: list[str] = [root]
+            while stack:
+                commit: str = stack[-1]
+                if commit in positions:
+                    stack.pop()
+                    continue
+                missing_parents: list[str] = [parent for parent in parents[commit] if parent not in positions and parent in parents]
+                if missing_parents:
+                    stack.extend(missing_parents)
+                    continue
+                stack.pop()
+                parent_positions: list[int] = [positions[parent] for parent in parents[commit] if parent in positions]
+                generations.append(1 + max((generations[position] for position in parent_positions), default=0))
+                positions[commit] = len(lines)
+                parent_fields: list[str] = [str(position) for position in parent_positions] + ["-", "-"]
+                lines.append(f"{commit} {parent_fields[0]} {parent_fields[1]} {generations[-1]} {self.get_commit_timestamp(commit)}\n")
+        with open(os.path.join(self.wit_path, f"{COMMIT_GRAPH_FILE_NAME}.tmp"), "w") as file:
+            file.writelines(lines)
+        os.replace(os.path.join(self.wit_path, f"{COMMIT_GRAPH_FILE_NAME}.tmp"), os.path.join(self.wit_path, COMMIT_GRAPH_FILE_NAME))
+
+    @traced
+    def load_commit_graph(self) -> dict[str, list]:
+        """Return the commit graph: `ids`, `positions`, `parents` (positions), `generations` and `timestamps`.
+
+        The graph file is read once and rebuilt if it is missing or
+        does not contain all the referenced commits.
+        """
+        if self.commit_graph is not None:
+            return self.commit_graph
+        graph_path: str = os.path.join(self.wit_path, COMMIT_GRAPH_FILE_NAME)
+        for _ in range(2):
+            if not os.path.exists(graph_path):
+                self.build_commit_graph_file()
+            self.commit_graph = {"ids": [], "positions": {}, "parents": [], "generations": [], "timestamps": []}
+            trace_count("metadata_files_opened")
+            with open(graph_path, "r") as file:
+                for line in file:
+                    commit, first_parent, second_parent, generation, timestamp = line.split()
+                    self.commit_graph["positions"][commit] = len(self.commit_graph["ids"])
+                    self.commit_graph["ids"].append(commit)
+                    self.commit_graph["parents"].append([int(parent) for parent in (first_parent, second_parent) if parent != "-"])
+                    self.commit_graph["generations"].append(int(generation))
+                    self.commit_graph["timestamps"].append(int(timestamp))
+            references: list[str | None] = list(self.get_references_data().values())
+            if all(commit in self.commit_graph["positions"] for commit in references if commit not in (None, "None")):
+                break
+            os.remove(graph_path)
+        return self.commit_graph
+
+    def add_to_commit_graph(self, commit: str, parents: list[str], timestamp: int | None = None) -> None:
+        """Append a new commit to the commit graph file (with the current time, or the timestamp of a fetched commit)."""
+        graph: dict[str, list] = self.load_commit_graph()
+        if commit in graph["positions"]:
+            # The graph file was just rebuilt from the details files, which include this commit.
+            return
+        parent_positions: list[int] = [graph["positions"][parent] for parent in parents if parent is not None]
+        generation: int = 1 + max((graph["generations"][position] for position in parent_positions), default=0)
+        timestamp = int(time.time()) if timestamp is None else timestamp
+        parent_fields: list[str] = [str(position) for position in parent_positions] + ["-", "-"]
+        with open(os.path.join(self.wit_path, COMMIT_GRAPH_FILE_NAME), "a") as file:
+            file.write(f"{commit} {parent_fields[0]} {parent_fields[1]} {generation} {timestamp}\n")
+        graph["positions"][commit] = len(graph["ids"])
+        graph["ids"].append(commit)
+        graph["parents"].append(parent_positions)
+        graph["generations"].append(generation)
+        graph["timestamps"].append(timestamp)
+        if self.sorted_commit_ids is not None:
+            bisect.insort(self.sorted_commit_ids, commit)
+
+    def get_sorted_commit_ids(self) -> list[str]:
+        """Return the IDs of all the commits in sorted order (sorted once)."""
+        if self.sorted_commit_ids is None:
+            self.sorted_commit_ids = sorted(self.load_commit_graph()["ids"])
+        return self.sorted_commit_ids
+
+    @traced
+    def resolve_commit(self, name: str) -> str:
+        """Return the commit ID of a branch name, `HEAD`, a commit ID or a unique prefix of a commit ID.
+
+        Args:
+            name (str): Branch name, commit ID or at least `SHORT_ID_MIN_LENGTH` first characters of a commit ID.
+
+        Raises:
+            FileNotFoundError: If no commit matches the name.
+            ValueError: If more than one commit starts with the prefix.
+
+        Returns:
+            str: The commit ID.
+        """
+        references_data: dict[str, str | None] = self.get_references_data()
+        if name == "HEAD" and references_data["HEAD"] is not None:
+            return references_data["HEAD"]
+        name = name.lower()
+        if references_data.get(name) not in (None, "None"):
+            return references_data[name]
+        sorted_ids: list[str] = self.get_sorted_commit_ids()
+        position: int = bisect.bisect_left(sorted_ids, name)
+        matches: list[str] = [commit for commit in sorted_ids[position:position + 2] if commit.startswith(name)]
+        if len(name) < SHORT_ID_MIN_LENGTH or not matches:
+            raise FileNotFoundError(f"Commit `{name}` not found.")
+        if len(matches) > 1 and matches[0] != name:
+            raise ValueError(f"Short commit ID `{name}` is ambiguous ({matches[0]}, {matches[1]}, ...).")
+        return matches[0]
+
+    @traced
+    def get_merge_base(self, commit: str, other_commit: str) -> str:
+        """Return the best common ancestor of two commits ("" if there is none).
+
+        Walks down from both commits in generation order (highest first), and returns the
+        first commit that is reached from both of them.
+        """
+        graph: dict[str, list] = self.load_commit_graph()
+        first: int = graph["positions"][commit]
+        second: int = graph["positions"][other_commit]
+        if first == second:
+            return commit
+        first_flag, second_flag = 1, 2
+        flags: dict[int, int] = {first: first_flag, second: second_flag}
+        queue: list[tuple[int, int]] = [(-graph["generations"][first], first), (-graph["generations"][second], second)]
+        heapq.heapify(queue)
+        while queue:
+            _, position = heapq.heappop(queue)
+            flag: int = flags[position]
+            if flag == first_flag | second_flag:
+                # Commits are visited by generation, so the first common one is the closest.
+                return graph["ids"][position]
+            for parent in graph["parents"][position]:
+                parent_flag: int = flags.get(parent, 0)
+                if parent_flag | flag != parent_flag:
+                    flags[parent] = parent_flag | flag
+                    heapq.heappush(queue, (-graph["generations"][parent], parent))
+        return ""
 
-def merge_files_by_data(current_file_in_stage: str, file_path_in_commit_to_merge: str, file_path_in_shared_parent: str, last_commit: str) -> None:
-    """Merge two files by compare there data.
+    def iter_log(self, start: str = "HEAD", since: int | None = None, paths: list[str] | None = None) -> Iterator[str]:
+        """Yield the commits reachable from start, newest first.
+
+        Commits are read from the commit graph while they are yielded, so
+        only the commits that the caller takes are visited.
+
+        Args:
+            start (str, optional): Branch name or (short) commit ID. Defaults to "HEAD".
+            since (int | None, optional): Stop at commits older than this unix timestamp. Defaults to None.
+            paths (list[str] | None, optional): Only commits that changed one of these paths (relative to the
+                repository) compared to their first parent. Defaults to None.
+        """
+        graph: dict[str, list] = self.load_commit_graph()
+        first: int = graph["positions"][self.resolve_commit(start)]
+        # Newest first, and a commit is before its parents when they have the same timestamp.
+        queue: list[tuple[int, int]] = [(-graph["timestamps"][first], -first)]
+        visited: set[int] = {first}
+        while queue:
+            timestamp, position = heapq.heappop(queue)
+            if since is not None and -timestamp < since:
+                return
+            parents: list[int] = graph["parents"][-position]
+            for parent in parents:
+                if parent not in visited:
+                    visited.add(parent)
+                    heapq.heappush(queue, (-graph["timestamps"][parent], -parent))
+            commit: str = graph["ids"][-position]
+            if paths:
+                tree_id: str | None = self.get_commit_tree(commit)
+                parent_tree_id: str | None = self.get_commit_tree(graph["ids"][parents[0]]) if parents else None
+                if all(self.get_tree_entry(tree_id, path) == self.get_tree_entry(parent_tree_id, path) for path in paths):
+                    continue
+            yield commit
+
+    @traced
+    def log(self, start: str = "HEAD", max_count: int | None = None, since: int | None = None, paths: list[str] | None = None) -> None:
+        """Print the history from start, newest first, while it is walked.
+
+        Args:
+            start (str, optional): Branch name or (short) commit ID. Defaults to "HEAD".
+            max_count (int | None, optional): Print at most this number of commits. Defaults to None.
+            since (int | None, optional): Only commits from this unix timestamp. Defaults to None.
+            paths (list[str] | None, optional): Only commits that changed these paths (relative to the
+                current folder). Defaults to None.
+        """
+        self.check_for_commits()
+        if paths:
+            paths = [os.path.relpath(os.path.abspath(path), self.root).replace(os.sep, "/") for path in paths]
+        names: dict[str, list[str]] = {}
+        for name, commit in self.get_references_data().items():
+            names.setdefault(commit, []).append(name)
+        for count, commit in enumerate(self.iter_log(start, since, paths)):
+            if max_count is not None and count >= max_count:
+                break
+            details: dict[str, str] = self.get_commit_details(commit)
+            print(f"commit {commit}" + (f" ({', '.join(names[commit])})" if commit in names else ""))
+            parents: list[str] = [parent for parent in self.get_parent(commit) if parent != "None"]
+            if len(parents) > 1:
+                print(f"Merge: {' '.join(get_short_commit_name(parent) for parent in parents)}")
+            print(f"Date:   {details['date']}\n")
+            for line in details["message"].splitlines():
+                print(f"    {line}")
+            print()
+
+    def iter_graph_commits(self, all: bool = False, revision_range: str | None = None) -> Iterator[int]:
+        """Yield the commit graph positions of the commits to draw, children before their parents.
+
+        Args:
+            all (bool, optional): All the commits. Defaults to False.
+            revision_range (str | None, optional): `A..B`, the commits reachable from B (default HEAD) and not
+                from A. Defaults to None (the commits reachable from HEAD).
+        """
+        graph: dict[str, list] = self.load_commit_graph()
+        if all and revision_range is None:
+            # Parents are always before their children in the commit graph.
+            yield from range(len(graph["ids"]) - 1, -1, -1)
+            return
+        excluded: set[int] = set()
+        end: str = "HEAD"
+        if revision_range is not None:
+            start, _, end = revision_range.partition("..")
+            stack: list[int] = [graph["positions"][self.resolve_commit(start or "HEAD")]]
+            excluded.update(stack)
+            while stack:
+                for parent in graph["parents"][stack.pop()]:
+                    if parent not in excluded:
+                        excluded.add(parent)
+                        stack.append(parent)
+        first: int = graph["positions"][self.resolve_commit(end or "HEAD")]
+        if first in excluded:
+            return
+        queue: list[int] = [-first]
+        seen: set[int] = {first}
+        while queue:
+            position: int = -heapq.heappop(queue)
+            yield position
+            for parent in graph["parents"][position]:
+                if parent not in seen and parent not in excluded:
+                    seen.add(parent)
+                    heapq.heappush(queue, -parent)
+
+    def get_graph_edges(self, positions: list[int], collapse: bool = False, keep: set[int] = frozenset()) -> dict[int, list[tuple[int, int]]]:
+        """Return the commits to draw and their edges to the drawn parents.
+
+        Args:
+            positions (list[int]): Commit graph positions of the commits in the window.
+            collapse (bool, optional): Replace chains of commits with one parent and one child
+                by a single edge. Defaults to False.
+            keep (set[int], optional): Commits that are never collapsed (e.g. the ones with a branch). Defaults to an empty set.
+
+        Returns:
+            dict[int, list[tuple[int, int]]]: Drawn commit -> [(parent, number of commits collapsed between them)],
+                in the order of positions.
+        """
+        parents: list[list[int]] = self.load_commit_graph()["parents"]
+        window: set[int] = set(positions)
+        hidden: set[int] = set()
+        if collapse:
+            children: dict[int, int] = {}
+            for position in positions:
+                for parent in parents[position]:
+                    children[parent] = children.get(parent, 0) + 1
+            hidden = {position for position in positions if position not in keep and children.get(position) == 1
+                      and len(parents[position]) == 1 and parents[position][0] in window}
+        edges: dict[int, list[tuple[int, int]]] = {}
+        for position in positions:
+            if position in hidden:
+                continue
+            edges[position] = []
+            for parent in parents[position]:
+                count: int = 0
+                while parent in hidden:
+                    parent = parents[parent][0]
+                    count += 1
+                if parent in window:
+                    edges[position].append((parent, count))
+        return edges
+
+    def iter_graph_text(self, edges: dict[int, list[tuple[int, int]]], names: dict[str, list[str]]) -> Iterator[str]:
+        """Yield the lines of a text graph: a line per commit with ASCII lanes (like `git log --graph --oneline`).
+
+        A line with `\\` follows a commit that starts new lanes (a merge or a fork), a line with `/`
+        follows a commit whose lane joins another lane, and a `:` line marks collapsed commits.
+        """
+        ids: list[str] = self.load_commit_graph()["ids"]
+        # The commit that every lane waits for (None for a free lane).
+        lanes: list[int | None] = []
+
+        def place(position: int) -> int:
+            index: int = lanes.index(None) if None in lanes else len(lanes)
+            lanes[index:index + 1] = [position]
+            return index
+
+        for position, parent_edges in edges.items():
+            column: int = lanes.index(position) if position in lanes else place(position)
+            commit: str = ids[position]
+            label: str = f" ({', '.join(names[commit])})" if commit in names else ""
+            message: str = self.get_commit_details(commit)["message"].partition("\n")[0]
+            yield " ".join("*" if index == column else "|" if lane is not None else " " for index, lane in enumerate(lanes)) \
+                + f"  {get_short_commit_name(commit)}{label} {message}"
+            lanes[column] = None
+            marks: dict[int, str] = {}
+            collapsed: list[tuple[int, int]] = []
+            for number, (parent, count) in enumerate(parent_edges):
+                if parent in lanes:
+                    index: int = lanes.index(parent)
+                    if number == 0:
+                        marks[column] = "/" if index < column else "\\"
+                elif number == 0:
+                    index = column
+                    lanes[column] = parent
+                else:
+                    index = place(parent)
+                    marks[index] = "\\" if index > column else "/"
+                if count:
+                    collapsed.append((index, count))
+            while lanes and lanes[-1] is None:
+                lanes.pop()
+            if marks:
+                yield " ".join(marks.get(index, "|" if index < len(lanes) and lanes[index] is not None else " ")
+                               for index in range(max(len(lanes), max(marks) + 1))).rstrip()
+            for lane_index, count in collapsed:
+                yield " ".join(":" if index == lane_index else "|" if lane is not None else " "
+                               for index, lane in enumerate(lanes)) + f"  ({count} commit(s))"
+
+    def iter_graph_dot(self, edges: dict[int, list[tuple[int, int]]], names: dict[str, list[str]]) -> Iterator[str]:
+        """Yield the lines of the graph in the DOT language (every commit is one node)."""
+        ids: list[str] = self.load_commit_graph()["ids"]
+        yield "digraph {"
+        yield "\trankdir=RL"
+        yield "\tnode [color=Aqua shape=circle style=filled]"
+        yield "\tedge [style=bold]"
+        for position, parent_edges in edges.items():
+            commit: str = ids[position]
+            yield f'\t"{commit}" [label="{commit[:6]}"]'
+            for parent, count in parent_edges:
+                yield f'\t"{commit}" -> "{ids[parent]}"' + (f' [label="{count} commit(s)" style=dashed]' if count else "")
+            for name in names.get(commit, []):
+                yield f'\t"{name}" [label="" style=invis]'
+                yield f'\t"{name}" -> "{commit}" [label="{name}"]'
+        yield "}"
+
+    @traced
+    def show_graph(self, all: bool = False, output_format: str | None = None, output: str | None = None,
+                   max_count: int | None = None, revision_range: str | None = None, collapse: bool = False) -> None:
+        """Show commit graph.
+
+        Without a format the graph is rendered with graphviz and opened in a viewer. With a format
+        it is written to the output (or printed), so it also runs without a display, e.g. in CI.
+
+        Args:
+            all (bool, optional): If True show all commits trees. Defaults to False.
+            output_format (str | None, optional): `svg`, `dot` or `text`. Defaults to None (open a viewer).
+            output (str | None, optional): File to write the graph to. Defaults to None (stdout).
+            max_count (int | None, optional): Draw only the newest commits. Defaults to None.
+            revision_range (str | None, optional): `A..B`, draw the commits reachable from B and not from A. Defaults to None.
+            collapse (bool, optional): Draw chains of commits with one parent and one child as a single edge. Defaults to False.
+
+        Raises:
+            ValueError: If the format is unknown.
+        """
+        self.check_for_commits()
+        if output_format is None and output is not None:
+            output_format = os.path.splitext(output)[1].lstrip(".") or "text"
+            output_format = "text" if output_format == "txt" else output_format
+        if output_format not in (None,) + GRAPH_FORMATS:
+            raise ValueError(f"Unknown graph format `{output_format}` (use {', '.join(GRAPH_FORMATS)}).")
+        graph: dict[str, list] = self.load_commit_graph()
+        names: dict[str, list[str]] = {}
+        for name, commit in self.get_references_data().items():
+            if commit in graph["positions"]:
+                names.setdefault(commit, []).append(name)
+        with trace_span("select_commits"):
+            positions: list[int] = list(itertools.islice(self.iter_graph_commits(all, revision_range), max_count))
+            edges: dict[int, list[tuple[int, int]]] = self.get_graph_edges(
+                positions, collapse, {graph["positions"][commit] for commit in names})
+        trace_count("commits_drawn", len(edges))
+        if output_format == "text":
+            lines: Iterator[str] = self.iter_graph_text(edges, names)
+        else:
+            lines = self.iter_graph_dot(edges, names)
+        if output_format in (None, "svg"):
+            # Imported only here, it is the slowest import and no other command needs it.
+            import graphviz
+            source = graphviz.Source("\n".join(lines), directory=os.path.join(self.wit_path, GRAPHS_FOLDER_NAME))
+            if output_format is None:
+                source.view()
+                return
+            data: bytes = source.pipe(format="svg")
+            if output is None:
+                sys.stdout.write(data.decode())
+            else:
+                with open(output, "wb") as file:
+                    file.write(data)
+            return
+        with open(output, "w", encoding="utf-8") if output is not None else contextlib.nullcontext(sys.stdout) as file:
+            for line in lines:
+                file.write(f"{line}\n")
+
+    @traced
+    def branch(self, name: str) -> None:
+        """Create a branch."""
+        name = name.lower()
+        if "/" in name or "=" in name:
+            raise ValueError(f"Branch name `{name}` can not contain `/` (used by remote references) or `=`.")
+        references_data: dict[str, str | None] = self.get_references_data()
+        if name in references_data.keys() or os.path.exists(self.get_manifest_path(name)):
+            print("The branch name already taken.\nPlease try different name.")
+            return
+        references_data[name] = references_data["HEAD"]
+        self.update_references_file(references_data)
+        print(f"New branch created: `{name}`.\nUse `checkout {name}` to activate.")
+
+    def get_remotes(self) -> dict[str, str]:
+        """Return the remote name -> repository path of every remote (from the remotes file)."""
+        remotes: dict[str, str] = {}
+        try:
+            with open(os.path.join(self.wit_path, REMOTES_FILE_NAME), "r", encoding="utf-8") as file:
+                for line in file:
+                    name, _, path = line.rstrip("\n").partition("=")
+                    remotes[name] = path
+        except FileNotFoundError:
+            pass
+        return remotes
+
+    def add_remote(self, name: str, path: str) -> None:
+        """Add a remote: another wit repository, by its path, to `push` to and `fetch` from.
+
+        Raises:
+            ValueError: If the name is taken or not valid, or the path is this repository.
+            FileNotFoundError: If there is no wit repository in the path.
+        """
+        remotes: dict[str, str] = self.get_remotes()
+        if not name or "/" in name or "=" in name:
+            raise ValueError(f"Remote name `{name}` can not be empty or contain `/` or `=`.")
+        if name in remotes:
+            raise ValueError(f"Remote `{name}` already exists ({remotes[name]}).")
+        root: str = Repository.find_root(path)
+        if root == self.root:
+            raise ValueError("A repository can not be a remote of itself.")
+        with open(os.path.join(self.wit_path, REMOTES_FILE_NAME), "a", encoding="utf-8") as file:
+            file.write(f"{name}={root}\n")
+        print(f"Remote `{name}` added: {root}")
+
+    def open_remote(self, name: str) -> "Repository":
+        """Return the repository of a remote.
+
+        Raises:
+            ValueError: If there is no remote with the name.
+        """
+        remotes: dict[str, str] = self.get_remotes()
+        if name not in remotes:
+            raise ValueError(f"Remote `{name}` not found (use `remote add {name} <path>`).")
+        return Repository(remotes[name])
+
+    @traced
+    def send_commits(self, destination: "Repository", wants: list[str]) -> tuple[int, int]:
+        """Copy the commits (and their ancestors) that the destination repository does not have, with their objects.
+
+        The two sides negotiate with their commit graphs: the destination has the ancestors of its
+        references (the haves) and of every commit in its graph, so only the ancestors of the wants
+        that are none of those are sent. Their objects are found by walking their trees, and a tree
+        that the destination has is skipped with all its subtrees. The objects are sent as one pack
+        written into the destination pack folder, then the chunk lists and the commit files (parents
+        before their children), so the destination never has a commit without its objects.
+
+        Args:
+            destination (Repository): The repository to copy to.
+            wants (list[str]): Commit IDs the destination should have.
+
+        Returns:
+            tuple[int, int]: Number of commits and number of objects sent.
+        """
+        graph: dict[str, list] = self.load_commit_graph()
+        destination_commits: dict[str, int] = destination.load_commit_graph()["positions"]
+        # 1 - the destination has the commit, 2 - the commit is sent.
+        marks: bytearray = bytearray(len(graph["ids"]))
+        stack: list[int] = [graph["positions"][commit] for commit in set(destination.get_references_data().values())
+                            if commit in graph["positions"]]
+        for position in stack:
+            marks[position] = 1
+        while stack:
+            for parent in graph["parents"][stack.pop()]:
+                if not marks[parent]:
+                    marks[parent] = 1
+                    stack.append(parent)
+        stack = [graph["positions"][commit] for commit in wants]
+        missing: list[int] = []
+        while stack:
+            position: int = stack.pop()
+            if marks[position] or graph["ids"][position] in destination_commits:
+                continue
+            marks[position] = 2
+            missing.append(position)
+            stack.extend(graph["parents"][position])
+        # Positions of parents are lower than the positions of their children.
+        missing.sort()
+        with trace_span("find_objects"):
+            object_ids: list[str] = []
+            chunked_ids: list[str] = []
+            seen: set[str] = set()
+            for position in missing:
+                trees: list[str | None] = [self.get_commit_tree(graph["ids"][position])]
+                while trees:
+                    tree_id: str | None = trees.pop()
+                    if tree_id is None or tree_id in seen or destination.has_object(tree_id):
+                        continue
+                    seen.add(tree_id)
+                    object_ids.append(tree_id)
+                    for kind, object_id in self.read_tree(tree_id, cache=False).values():
+                        if kind == "tree":
+                            trees.append(object_id)
+                        elif object_id not in seen and not destination.has_object(object_id):
+                            seen.add(object_id)
+                            chunk_list: list[tuple[str, int]] | None = self.read_chunk_list(object_id)
+                            if chunk_list is None:
+                                object_ids.append(object_id)
+                                continue
+                            chunked_ids.append(object_id)
+                            for chunk_id, _ in chunk_list:
+                                if chunk_id not in seen and not destination.has_object(chunk_id):
+                                    seen.add(chunk_id)
+                                    object_ids.append(chunk_id)
+        with trace_span("send_objects"):
+            if object_ids:
+                self.write_pack(object_ids, {}, os.path.join(destination.wit_path, SUB_FOLDER_NAMES["objects"], PACK_FOLDER_NAME))
+                destination.close_packs()
+            for object_id in chunked_ids:
+                with open(self.get_chunk_list_path(object_id), "rb") as file:
+                    destination.write_object(object_id + CHUNK_LIST_SUFFIX, file.read())
+            for position in missing:
+                commit: str = graph["ids"][position]
+                copy_file(self.get_manifest_path(commit), destination.get_manifest_path(commit))
+                copy_file(os.path.join(self.wit_path, SUB_FOLDER_NAMES["images"], f"{commit}.txt"),
+                          os.path.join(destination.wit_path, SUB_FOLDER_NAMES["images"], f"{commit}.txt"))
+                destination.add_to_commit_graph(commit, [graph["ids"][parent] for parent in graph["parents"][position]],
+                                                graph["timestamps"][position])
+        trace_count("commits_sent", len(missing))
+        trace_count("objects_sent", len(object_ids) + len(chunked_ids))
+        return len(missing), len(object_ids) + len(chunked_ids)
+
+    def push(self, remote: str, branch: str | None = None) -> None:
+        """Send a branch (with the commits and objects the remote does not have) to a remote and update the branch there.
+
+        Args:
+            remote (str): Remote name.
+            branch (str | None, optional): Branch to push. Defaults to None (the activated branch).
+
+        Raises:
+            ValueError: If there is no such branch, the remote branch has commits that the branch does not
+                have (fetch and merge them first), or the branch is checked out in the remote and it has changes.
+        """
+        branch = (branch or self.get_activated_branch()).lower()
+        references_data: dict[str, str | None] = self.get_references_data()
+        commit: str | None = references_data.get(branch)
+        if "/" in branch or commit in (None, "None"):
+            raise ValueError(f"There is no branch `{branch}` with commits to push.")
+        destination: Repository = self.open_remote(remote)
+        destination_references: dict[str, str | None] = destination.get_references_data()
+        old_commit: str | None = destination_references.get(branch)
+        checked_out: bool = destination.get_activated_branch() == branch
+        if old_commit not in (None, "None"):
+            if old_commit not in self.load_commit_graph()["positions"] or self.get_merge_base(old_commit, commit) != old_commit:
+                raise ValueError(f"Push of `{branch}` rejected: `{remote}/{branch}` has commits that `{branch}` does not have, "
+                                 f"use `fetch {remote}` and `merge {remote}/{branch}` first.")
+            if checked_out and old_commit != commit:
+                # The working tree of the remote is moved to the pushed commit, so it must have no changes.
+                destination_status: dict[str, list[str] | str | None] = destination.get_status()
+                if destination_status["Current commit:"] != old_commit or destination_status["Changes to be committed:"] \
+                        or destination_status["Changes not staged for commit:"] or destination.get_merge_head():
+                    raise ValueError(f"Push of `{branch}` rejected: the branch is checked out in `{destination.root}` "
+                                     f"and it has changes, commit them there or use `fetch` from there instead.")
+        commits, objects = self.send_commits(destination, [commit])
+        destination_references[branch] = commit
+        if checked_out and destination_references["HEAD"] in (None, "None"):
+            # The remote has no commits yet, so the pushed branch is checked out there.
+            destination_references["HEAD"] = commit
+            destination.update_references_file(destination_references)
+            destination.checkout(branch, True)
+        else:
+            destination.update_references_file(destination_references)
+            if checked_out and old_commit != commit:
+                # Only the files that differ between the old and the pushed commit are written.
+                destination.checkout(branch)
+        references_data[f"{remote}/{branch}"] = commit
+        self.update_references_file(references_data)
+        print(f"Pushed {commits} commit(s) and {objects} object(s) to `{remote}`: "
+              f"{branch} {get_short_commit_name(old_commit or 'None')}..{get_short_commit_name(commit)}")
+
+    def fetch(self, remote: str) -> None:
+        """Copy the branches of a remote (with the commits and objects this repository does not have).
+
+        The branches are stored as `remote/branch` references, that can be merged or checked out (detached).
+
+        Args:
+            remote (str): Remote name.
+        """
+        source: Repository = self.open_remote(remote)
+        branches: dict[str, str] = {branch: commit for branch, commit in source.get_references_data().items()
+                                    if branch != "HEAD" and "/" not in branch and commit not in (None, "None")}
+        commits, objects = source.send_commits(self, list(branches.values()))
+        references_data: dict[str, str | None] = {name: commit for name, commit in self.get_references_data().items()
+                                                  if not name.startswith(f"{remote}/")}
+        references_data.update((f"{remote}/{branch}", commit) for branch, commit in branches.items())
+        self.update_references_file(references_data)
+        print(f"Fetched {commits} commit(s) and {objects} object(s) from `{remote}`: "
+              + ", ".join(f"{remote}/{branch}" for branch in branches))
+
+    def get_merge_head(self) -> str | None:
+        """Return the commit of the merge that stopped on conflicts (None if there is none)."""
+        try:
+            with open(os.path.join(self.wit_path, MERGE_HEAD_FILE_NAME), "r") as file:
+                return file.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def set_merge_head(self, commit: str | None) -> None:
+        """Save the commit of a merge that stopped on conflicts (None to remove it)."""
+        merge_head_path: str = os.path.join(self.wit_path, MERGE_HEAD_FILE_NAME)
+        if commit is not None:
+            with open(merge_head_path, "w") as file:
+                file.write(commit)
+        elif os.path.exists(merge_head_path):
+            os.remove(merge_head_path)
+
+    def get_shared_parent(self, name: str) -> str:
+        """get commits shared parent."""
+        references_data: dict[str, str | None] = self.get_references_data()
+        return self.get_merge_base(references_data["HEAD"], name)
+
+    @traced
+    def merge(self, name_to_merge: str) -> None:
+        """Merge between two branches\commits.
+
+        The files that changed in both versions are merged by a pool of worker processes into a
+        scratch folder. If some files conflict, the other files are merged and staged, the conflicts
+        of text files are marked in the working tree files, and the commit to merge is saved (see
+        `get_merge_head`): the merge is finished by fixing the files, `add` and `commit`.
+
+        Raises:
+            ValueError: With all the conflicting files, or if a merge that stopped on conflicts was not committed yet.
+        """
+        self.check_for_commits()
+        if self.get_merge_head() is not None:
+            raise ValueError(f"The merge of `{self.get_merge_head()}` has conflicts, fix them, `add` and `commit` first.")
+        status_data: dict[str, list[str] | str | None] = self.get_status()
+        check_for_changes(status_data)
+        commit_to_merge: str = self.resolve_commit(name_to_merge)
+        current_commit: str = status_data["Current commit:"]
+        if current_commit == commit_to_merge:
+            return
+        shared_parent: str = self.get_shared_parent(commit_to_merge)
+        if shared_parent == commit_to_merge:
+            print(f"Already up to date with `{commit_to_merge}`.")
+            return
+        staging_area: str = os.path.join(self.wit_path, SUB_FOLDER_NAMES["staging_area"])
+        index: dict[str, list] = self.load_index()
+        # File -> object ID to stage, for the files that were changed or added in the commit to
+        # merge since the shared parent (subtrees that did not change are skipped).
+        changes: dict[str, str | None] = {}
+        # File -> (shared parent object ID, object ID to merge) of files that changed in both versions.
+        merges: dict[str, tuple[str | None, str]] = {}
+        for file, (parent_id, object_id) in self.diff_trees(self.get_commit_tree(shared_parent),
+                                                             self.get_commit_tree(commit_to_merge)).items():
+            if object_id is None or file in index and index[file][0] == object_id:
+                continue
+            if file not in index or index[file][0] == parent_id:
+                changes[file] = object_id
+            else:
+                merges[file] = (parent_id, object_id)
+        # Packed objects are extracted here, and the merged files are written here.
+        scratch_folder: str = tempfile.mkdtemp(dir=self.wit_path)
+        report: list[str] = []
+        try:
+            conflicts: dict[str, int] = {}
+            jobs: dict[str, tuple[str, str, str, str, str]] = {}
+            # The three versions of these files have different object IDs (the hash of the content,
+            # also for files stored as chunks), so binary files conflict without reading them.
+            binary_conflicts: set[str] = {file for file in merges if not is_text_file(os.path.join(staging_area, file))}
+            if len(binary_conflicts) < len(merges):
+                with trace_span("merge_files"):
+                    for number, (file, (parent_id, object_id)) in enumerate(merges.items()):
+                        if file in binary_conflicts:
+                            continue
+                        jobs[file] = (os.path.join(staging_area, file),
+                                      self.extract_object(object_id, scratch_folder),
+                                      os.devnull if parent_id is None else self.extract_object(parent_id, scratch_folder),
+                                      os.path.join(scratch_folder, f"{number}.merged"),
+                                      get_short_commit_name(commit_to_merge))
+                    if len(jobs) < MERGE_POOL_MIN_FILES:
+                        results: Iterator[int] = map(merge_files_by_lines, *zip(*jobs.values()))
+                        conflicts = dict(zip(jobs, results))
+                    else:
+                        import concurrent.futures
+                        with concurrent.futures.ProcessPoolExecutor(min(len(jobs), os.cpu_count() or 1)) as pool:
+                            conflicts = dict(zip(jobs, pool.map(merge_files_by_lines, *zip(*jobs.values()), chunksize=16)))
+                    trace_count("files_merged", len(jobs))
+            conflicted_files: list[str] = sorted(binary_conflicts.union(file for file, count in conflicts.items() if count))
+            hidden_files: list[str] = [file for file in conflicted_files if not self.is_sparse(file)]
+            if hidden_files:
+                # The conflicts could not be fixed in the working tree, so nothing is staged.
+                raise ValueError(f"Merge of `{commit_to_merge}` failed, nothing was staged: files outside the sparse checkout "
+                                 "paths conflict, add their folders to the paths (see `sparse`) and merge again. Conflicts:\n"
+                                 + "\n".join(f"\t{file}" for file in hidden_files))
+            for file in conflicted_files:
+                if file in binary_conflicts:
+                    report.append(f"\t{file} (binary file changed in both versions, the current version is kept)")
+                else:
+                    # Leave the conflict markers in the working tree file for the user to fix.
+                    os.replace(jobs[file][3], self.get_worktree_path(file))
+                    report.append(f"\t{file} ({conflicts[file]} conflict(s) marked in the file)")
+            merged_files: list[str] = [file for file in jobs if not conflicts[file]]
+            for file, object_id in zip(merged_files, hash_files([jobs[file][3] for file in merged_files])):
+                changes[file] = self.store_object(jobs[file][3], object_id)
+        finally:
+            shutil.rmtree(scratch_folder, ignore_errors=True)
+        with trace_span("apply_merge"):
+            self.sync_stage_area(index, changes)
+            self.index_tree = None
+            self.save_index(index)
+            if not report:
+                self.commit(f"Merge {commit_to_merge} with {current_commit}", commit_to_merge)
+            # The working tree matched the stage, so only the merged files are written (in the sparse checkout paths).
+            index = self.load_index()
+            for file, object_id in changes.items():
+                if not self.is_sparse(file):
+                    continue
+                file_path: str = self.get_worktree_path(file)
+                self.restore_object(object_id, file_path)
+                update_index_entry(index, file, object_id, file_path)
+            self.save_index(index)
+        if report:
+            self.set_merge_head(commit_to_merge)
+            raise ValueError(f"Merge of `{commit_to_merge}` has conflicts, the other files were merged and staged. "
+                             "Fix the conflicts, `add` and `commit` to finish the merge. Conflicts:\n" + "\n".join(report))
+
+
+# Repositories kept by their root while a batch runs (see `run_batch`), None to open them for every command.
+open_repositories: dict[str, Repository] | None = None
+
+
+def open_repository(path: str = ".") -> Repository:
+    """Return the repository of the folder, the same object for every command of a batch."""
+    if open_repositories is None:
+        return Repository(path)
+    root: str = Repository.find_root(path)
+    if root not in open_repositories:
+        open_repositories[root] = Repository(root)
+    return open_repositories[root]
+
+
+def run_batch(lines: Iterable[str]) -> int:
+    """Run wit commands, one per line, in this process (`python wit.py batch < commands.txt`).
+
+    A line has the arguments of a command as in a shell (`commit "first commit"`) or as a JSON list
+    (`["commit", "first commit"]`). Empty lines and lines that start with `#` are skipped, and
+    `cd <folder>` changes the current folder. The interpreter starts once, and every repository is
+    opened once (see `open_repository`), so its references, commit graph, packs and trees are read
+    once for all the commands. Nothing else should change the repositories while the batch runs.
 
     Args:
-        current_file_in_stage (str): The current file.
-        file_path_in_commit_to_merge (str): The file to merge into current file.
-        file_path_in_shared_parent (str): The common base file for merge and current.
-        last_commit (str): The last commit id.
+        lines (Iterable[str]): The commands (e.g. `sys.stdin`, read line by line).
+
+    Returns:
+        int: Number of commands that failed (their errors are printed, the next commands still run).
     """
-    if filecmp.cmp(current_file_in_stage, file_path_in_commit_to_merge):
-        shutil.copy2(file_path_in_commit_to_merge, current_file_in_stage)
-    elif filecmp.cmp(current_file_in_stage, file_path_in_shared_parent):
-        shutil.copy2(file_path_in_commit_to_merge, current_file_in_stage)
-    elif filecmp.cmp(file_path_in_commit_to_merge, file_path_in_shared_parent):
-        shutil.copy2(current_file_in_stage, current_file_in_stage)
-    else:
-        update_stage_area(os.path.join(BASE_FOLDER_NAME, SUB_FOLDER_NAMES["images"], last_commit))
-        raise ValueError(f"Conflict between file -> `{os.path.basename(current_file_in_stage)}`")
-
-
-def get_shared_parent(name: str) -> str:
-    """get commits shared parent."""
-    references_data: dict[str, str | None] = get_references_data()
-    current_commit: list[tuple[str, str, int]] = get_current_commit_tree(references_data["HEAD"])
-    name_commit: list[tuple[str, str, int]] = get_current_commit_tree(name)
-    shared_parent: str = ""
-    shared_parent_distance: int = len(current_commit)+ len(name_commit)
-    for commit, _, distance in current_commit:
-        for parent, _, distance_2 in name_commit:
-            distance_between: int = distance + distance_2
-            if commit == parent and distance_between < shared_parent_distance:
-                shared_parent = commit
-                shared_parent_distance = distance_between
-    return shared_parent
-
-
-def merge(name_to_merge: str) -> None:
-    """Merge between two branches\commits."""
-    find_wit_folder()
-    check_for_commits()
-    status_data: dict[str, list[str] | str | None] = get_status()
-    check_for_changes(status_data)
-    commit_to_merge = name_to_merge.lower()
-    references_data: dict[str, str | None] = get_references_data()
-    if commit_to_merge in references_data.keys():
-        commit_to_merge = references_data[commit_to_merge]
-    if status_data["Current commit:"] == commit_to_merge:
-        return
-    shared_parent: str = get_shared_parent(commit_to_merge)
-    commit_to_merge_path: str = os.path.join(os.getcwd(), BASE_FOLDER_NAME, SUB_FOLDER_NAMES["images"], commit_to_merge)
-    shared_parent_path: str = os.path.join(os.getcwd(), BASE_FOLDER_NAME, SUB_FOLDER_NAMES["images"], shared_parent)
-    status = get_status(commit_to_merge_path, shared_parent_path, "")
-    current_commit_and_destination_path: str = os.path.join(os.getcwd(), BASE_FOLDER_NAME, SUB_FOLDER_NAMES["staging_area"])
-    all_changes: list[str] = status["Changes not staged for commit:"] + status["Untracked files:"]
-    for file in all_changes:
-        current_file_in_stage: str = os.path.join(current_commit_and_destination_path, file)
-        file_path_in_commit_to_merge: str = os.path.join(commit_to_merge_path, file)
-        if os.path.exists(current_file_in_stage):
-            file_path_in_shared_parent: str = os.path.join(shared_parent_path, file)
+    global open_repositories
+    open_repositories = {}
+    failed: int = 0
+    try:
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
             try:
-                with open(current_file_in_stage, "r", encoding="utf-8") as f:
-                    f.readline()
-            except UnicodeDecodeError:
-                merge_files_by_data(current_file_in_stage, file_path_in_commit_to_merge, file_path_in_shared_parent, status_data["Current commit:"])
-            else:
-                merge_files_by_lines(current_file_in_stage, file_path_in_commit_to_merge, file_path_in_shared_parent, status_data["Current commit:"])
-        else:
-            os.makedirs(current_file_in_stage.removesuffix(os.path.basename(file)), exist_ok=True)
-            shutil.copy2(file_path_in_commit_to_merge, current_file_in_stage)
-    commit(f"Merge {commit_to_merge} with {status['Current commit:']}", commit_to_merge)
-    status = get_status()
-    checkout(status['Current commit:'], ignore=True)
+                args: list[str] = json.loads(line) if line.startswith("[") else shlex.split(line)
+                with trace_span(f"wit {args[0]}"):
+                    if args[0] == "cd":
+                        os.chdir(args[1])
+                    else:
+                        run_command(["wit"] + args)
+            except Exception as error:
+                failed += 1
+                # A command that failed may leave the state it read half updated.
+                open_repositories.clear()
+                print(f"wit: `{line}` failed: {type(error).__name__}: {error}", file=sys.stderr)
+            sys.stdout.flush()
+    finally:
+        open_repositories = None
+    return failed
 
 
 def print_wit_welcome() -> None:
@@ -528,43 +3529,150 @@ usually used for coordinating work among programmers who are collaboratively dev
               
 Use: python `wit_path` <commend> <argument>
 
-Supports the following commands:
-init, add <path>, commit <message>, status, checkout <commit\\branch>, graph(--all, optional), branch <commit\\branch>, merge <commit\\branch>""")
+Supports the following commands (add `--trace[=text|json|chrome]` to print a trace of the command):
+init, add <path>, commit <message>, status <path>(optional), checkout <commit\\branch>,
+graph(--all, --format=svg|dot|text, --output=<file>, --max-count=<n>, <commit>..<commit>, --collapse, optional), branch <commit\\branch>, merge <commit\\branch>,
+log <commit\\branch>(optional, --max-count=<n>, --since=<date>, -- <path>...), repack(--all, optional), gc(--grace=<days>, optional),
+sparse <path>...(optional, --disable), remote add <name> <path>, push <remote> <branch>(optional), fetch <remote>,
+watch(--poll, optional), batch (commands from stdin, one per line)
+Commits can be given by a unique prefix of their ID (at least 4 characters).""")
 
 
 def main(args):
+    """Run a wit command, traced if `--trace[=format]` is passed or `WIT_TRACE` is set."""
+    trace_format: str | None = os.environ.get(TRACE_ENVIRONMENT_NAME, "").strip().lower() or None
+    if trace_format in ("0", "false", "no"):
+        trace_format = None
+    elif trace_format in ("1", "true", "yes"):
+        trace_format = "text"
+    for arg in args[1:]:
+        if arg == "--trace" or arg.startswith("--trace="):
+            trace_format = arg.partition("=")[2] or "text"
+            args = [other_arg for other_arg in args if other_arg != arg]
+            break
+    if trace_format is None:
+        run_command(args)
+        return
+    start_tracing(trace_format)
+    try:
+        with trace_span(f"wit {args[1]}" if len(args) > 1 else "wit"):
+            run_command(args)
+    finally:
+        finish_tracing()
+
+
+def run_command(args):
+    """Run one command on the repository of the current folder."""
     if len(args) < 2:
         print_wit_welcome()
         return
     if args[1] == "init":
-        init()
+        Repository.init()
     elif args[1] == "add":
         if len(args) < 3:
             raise TypeError("`add` commend missing 1 required argument - `path`.")
-        add(args[2])
+        # The repository is searched from the added path.
+        path: str = os.path.abspath(args[2])
+        open_repository(path if os.path.isdir(path) else os.path.dirname(path)).add(path)
     elif args[1] == "commit":
         if len(args) < 3:
             raise TypeError("`commit` commend missing 1 required argument - `message`.")
-        commit(args[2])
+        open_repository().commit(args[2])
     elif args[1] == "status":
-        print_status()
+        open_repository().print_status(args[2] if len(args) > 2 else None)
     elif args[1] == "checkout":
         if len(args) < 3:
             raise TypeError("`checkout` commend missing 1 required argument - `commit ID`.")
-        checkout(args[2])
+        open_repository().checkout(args[2])
     elif args[1] == "graph":
-        if len(args) == 3 and args[2] == "--all":
-            show_graph(True)
-        else:
-            show_graph()
+        graph_options: dict = {"all": False, "output_format": None, "output": None,
+                               "max_count": None, "revision_range": None, "collapse": False}
+        for option in args[2:]:
+            if option in ("--all", "--collapse"):
+                graph_options[option[2:]] = True
+            elif option.startswith("--format="):
+                graph_options["output_format"] = option.partition("=")[2]
+            elif option.startswith("--output="):
+                graph_options["output"] = option.partition("=")[2]
+            elif option.startswith("--max-count="):
+                graph_options["max_count"] = int(option.partition("=")[2])
+            elif ".." in option:
+                graph_options["revision_range"] = option
+            else:
+                raise TypeError(f"Unknown `graph` option `{option}`.")
+        open_repository().show_graph(**graph_options)
     elif args[1] == "branch":
         if len(args) < 3:
             raise TypeError("`branch` commend missing 1 required argument - `NAME`.")
-        branch(args[2])
+        open_repository().branch(args[2])
     elif args[1] == "merge":
         if len(args) < 3:
             raise TypeError("`merge` commend missing 1 required argument - `BRANCH_NAME`.")
-        merge(args[2])
+        open_repository().merge(args[2])
+    elif args[1] == "log":
+        start: str = "HEAD"
+        max_count: int | None = None
+        since: int | None = None
+        paths: list[str] = []
+        options: list[str] = args[2:]
+        if "--" in options:
+            paths = options[options.index("--") + 1:]
+            options = options[:options.index("--")]
+        for option in options:
+            if option.startswith("--max-count="):
+                max_count = int(option.partition("=")[2])
+            elif option.startswith("--since="):
+                since = parse_date(option.partition("=")[2])
+            elif option.startswith("-"):
+                raise TypeError(f"Unknown `log` option `{option}`.")
+            else:
+                start = option
+        open_repository().log(start, max_count, since, paths)
+    elif args[1] == "repack":
+        open_repository().repack(len(args) == 3 and args[2] == "--all")
+    elif args[1] == "sparse":
+        repository: Repository = open_repository()
+        if len(args) == 2:
+            print("\n".join(repository.get_sparse_paths()) or "The whole working tree is checked out.")
+        else:
+            repository.set_sparse_paths([] if args[2:] == ["--disable"] else args[2:])
+    elif args[1] == "remote":
+        repository: Repository = open_repository()
+        if len(args) == 5 and args[2] == "add":
+            repository.add_remote(args[3], args[4])
+        elif len(args) == 2:
+            for name, path in repository.get_remotes().items():
+                print(f"{name}\t{path}")
+        else:
+            raise TypeError("Use `remote add <NAME> <PATH>` or `remote` to list the remotes.")
+    elif args[1] == "push":
+        if len(args) < 3:
+            raise TypeError("`push` commend missing 1 required argument - `REMOTE`.")
+        open_repository().push(args[2], args[3] if len(args) > 3 else None)
+    elif args[1] == "fetch":
+        if len(args) < 3:
+            raise TypeError("`fetch` commend missing 1 required argument - `REMOTE`.")
+        open_repository().fetch(args[2])
+    elif args[1] == "gc":
+        grace_period: float = GC_GRACE_PERIOD
+        for option in args[2:]:
+            if option.startswith("--grace="):
+                grace_period = float(option.partition("=")[2]) * 24 * 60 * 60
+            else:
+                raise TypeError(f"Unknown `gc` option `{option}`.")
+        open_repository().gc(grace_period)
+    elif args[1] == "batch":
+        if open_repositories is not None:
+            raise ValueError("`batch` can not run inside a batch.")
+        failed: int = run_batch(sys.stdin)
+        if failed:
+            print(f"{failed} command(s) failed.", file=sys.stderr)
+            raise SystemExit(1)
+    elif args[1] == "watch":
+        open_repository().watch(len(args) == 3 and args[2] == "--poll")
+    elif open_repositories is not None:
+        # Inside a batch the command is counted as failed.
+        raise ValueError(f"Commend `{args[1]}` not found.")
     else:
         print("Commend not found.")
 